@@ -1,59 +1,1006 @@
 import discord
 from discord import app_commands
 from discord.ext import tasks
-import a2s
 import json
 import os
+import random
 import asyncio
+import bz2
+import contextvars
+import hashlib
+import heapq
+import io
+import itertools
+import ipaddress
+import logging
+import logging.handlers
+import math
+import multiprocessing
+import queue
 import re
+import signal
+import sqlite3
+import socket
+import struct
+import sys
 import time
-from datetime import datetime
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from types import MappingProxyType
 from typing import Optional
 
+from charts import render_sparklines
+
 # ==================== КОНФИГУРАЦИЯ ====================
 BOT_TOKEN = ""
 CONFIG_FILE = "config.json"
+STATE_DB_FILE = "state.db"    # Часто меняющееся состояние (онлайн, id сообщений)
+SNAPSHOT_FILE = "snapshot.json"  # Снимок кэша и опубликованных плашек для тёплого старта
+SNAPSHOT_MAX_AGE = 1800    # Более старый снимок при запуске игнорируется (секунды)
+A2S_TIMEOUT = 5.0          # Общий бюджет времени на A2S запрос со всеми повторами (секунды)
+A2S_INITIAL_RTO = 1.0      # Таймаут попытки, пока время ответа сервера неизвестно (секунды)
+A2S_MIN_RTO = 0.2          # Минимальный таймаут одной попытки (секунды)
+A2S_MAX_ATTEMPTS = 4       # Максимум отправок запроса в пределах бюджета
+DNS_CACHE_TTL = 300        # Сколько помнить результат резолва доменного имени
+POLL_CONCURRENCY = 50      # Сколько A2S запросов может выполняться одновременно
+DISCORD_CONCURRENCY = 2    # Сколько обработчиков очереди публикации работают с Discord одновременно
+CACHE_TTL = 30             # Время жизни удачного ответа в кэше (секунды)
+CACHE_NEGATIVE_TTL = 10    # Время жизни ошибки запроса в кэше (секунды)
+CACHE_MAX_SIZE = 1024      # Максимум адресов в кэше (старые вытесняются)
+SCHEDULER_TICK = 5         # Как часто планировщик проверяет, кого пора опросить (секунды)
+POLL_DEFAULT_INTERVAL = 60 # Интервал опроса, пока о сервере мало данных (секунды)
+POLL_MIN_INTERVAL = 30     # Самый частый опрос активного сервера (секунды)
+POLL_MAX_INTERVAL = 300    # Самый редкий опрос стабильного сервера (секунды)
+POLL_HISTORY_SIZE = 10     # Сколько последних опросов учитывать при выборе интервала
+BREAKER_FAILURE_THRESHOLD = 3  # Ошибок подряд, после которых сервер считается офлайн
+BREAKER_BASE_BACKOFF = 15  # Первая пауза после ошибки (секунды), дальше удваивается
+BREAKER_MAX_BACKOFF = 900  # Самая длинная пауза между проверками недоступного сервера
+VOICE_RENAME_LIMIT = 2     # Сколько раз Discord позволяет переименовать канал...
+VOICE_RENAME_WINDOW = 600  # ...за это окно (секунды)
+DISCORD_GLOBAL_RATE = 40   # Общий лимит запросов бота к Discord (в секунду, у Discord — 50)
+DISCORD_GLOBAL_BURST = 5   # Сколько запросов можно подряд сверх темпа (темп + запас не больше 50 за секунду)
+DISCORD_MAX_IN_FLIGHT = 8  # Сколько запросов к Discord выполняется одновременно
+DISCORD_MAX_RETRIES = 3    # Сколько раз повторять запрос после 429
+DISCORD_MAX_RATELIMIT_WAIT = 30  # Более долгий Retry-After discord.py отдаёт планировщику, а не пережидает сам (минимум библиотеки — 30)
+DISCORD_PANEL_DEADLINE = 90  # Через сколько секунд неотправленная правка плашки отбрасывается
+PANEL_MAX_EMBEDS = 10      # Сколько серверов помещается в одну общую плашку (лимит Discord)
+PANEL_MAX_STALENESS = 600  # По умолчанию: дольше этого плашка не показывает устаревший онлайн (секунды)
+STATS_MAX_GAP = 1200       # Дольше этого промежуток между опросами не засчитывается в аптайм (секунды)
+CHART_WINDOW = 6 * 3600    # Какой период показывает график онлайна на плашке (секунды)
+CHART_POINTS = 72          # Сколько столбцов в графике (по 5 минут)
+CHART_WIDTH = 288          # Размер картинки графика в пикселях
+CHART_HEIGHT = 64
+CHART_WORKERS = 2          # Процессов для отрисовки графиков
+CHART_CACHE_SIZE = 256     # Сколько готовых картинок держать в памяти
+LOG_LEVEL = "INFO"         # DEBUG — подробные записи о кэше и пропущенных правках
+LOG_FILE = None            # Файл для логов (JSON по строке на запись); None — stdout
+METRICS_HOST = "127.0.0.1" # Адрес HTTP-эндпоинта метрик Prometheus (/metrics)
+METRICS_PORT = 9108        # Порт метрик; 0 — не запускать
+# Уровни истории онлайна: (шаг в секундах, сколько шагов хранить)
+HISTORY_TIERS = [
+    (60, 1440),     # По минутам за сутки
+    (3600, 720),    # По часам за 30 дней
+    (86400, 365)    # По дням за год
+]
+# Лимиты по типу маршрута: (запросов в секунду, запас подряд)
+DISCORD_ROUTE_LIMITS = {
+    "message": (1.0, 5),      # Сообщения канала: 5 запросов за 5 секунд
+    "channel": (0.5, 2),      # Изменение канала
+    "interaction": (5.0, 5)   # Follow-up ответы на команды
+}
+
+# ==================== ЛОГИРОВАНИЕ ====================
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись: время, уровень, подсистема, сообщение и поля из extra"""
+
+    RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "tag": record.name.rsplit(".", 1)[-1].upper(),
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть: подстановка аргументов и JSON — в потоке QueueListener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+log_listener = None
+
+def setup_logging():
+    """Направляет логи бота через очередь в отдельный поток (один раз за жизнь процесса)"""
+    global log_listener
+    if log_listener is not None:
+        return
+    handler = logging.FileHandler(LOG_FILE, encoding="utf-8") if LOG_FILE else logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger("bot")
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.propagate = False
+
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток логов"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+bot_log = logging.getLogger("bot")
+a2s_log = logging.getLogger("bot.a2s")
+cache_log = logging.getLogger("bot.cache")
+state_log = logging.getLogger("bot.state")
+stats_log = logging.getLogger("bot.stats")
+config_log = logging.getLogger("bot.config")
+discord_log = logging.getLogger("bot.discord")
+update_log = logging.getLogger("bot.update")
+panel_log = logging.getLogger("bot.panel")
+voice_log = logging.getLogger("bot.voice")
+breaker_log = logging.getLogger("bot.breaker")
+publish_log = logging.getLogger("bot.publish")
+chart_log = logging.getLogger("bot.chart")
+task_log = logging.getLogger("bot.task")
+metrics_log = logging.getLogger("bot.metrics")
+commands_log = logging.getLogger("bot.commands")
+snapshot_log = logging.getLogger("bot.snapshot")
+
+# ==================== МЕТРИКИ ====================
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Счётчик Prometheus с метками; значения хранятся по кортежу значений меток"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        if not labels:
+            self.values[()] = 0.0
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {value:g}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        if not labels:
+            self.values[()] = [0] * len(buckets) + [0.0, 0]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]  # корзины, сумма, количество
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self):
+        for key, state in self.values.items():
+            for bound, count in zip(self.buckets, state):
+                labels = _format_labels(self.labels, key, 'le="%g"' % bound)
+                yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labels, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {state[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {state[-2]:g}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {state[-1]}"
+
+class BotMetrics:
+    """Метрики горячих путей бота: опрос, кэш, цикл планировщика, запросы к Discord, правки плашек"""
+
+    def __init__(self):
+        self.a2s_latency = Histogram(
+            "bot_a2s_latency_seconds", "Время удачного A2S запроса (со всеми повторами)",
+            (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0), ("server",)
+        )
+        self.a2s_failures = Counter("bot_a2s_failures_total", "Неудачные A2S запросы", ("server",))
+        self.cache_requests = Counter(
+            "bot_cache_requests_total", "Обращения к кэшу запросов: hit, stale, negative, miss", ("result",)
+        )
+        self.cycle_duration = Histogram(
+            "bot_poll_cycle_seconds", "Длительность цикла auto_update_servers",
+            (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+        )
+        self.cycle_overruns = Counter("bot_poll_cycle_overruns_total", "Циклы опроса дольше SCHEDULER_TICK")
+        self.cycle_missed_ticks = Counter(
+            "bot_poll_cycle_missed_ticks_total", "Такты планировщика, пропущенные из-за долгого цикла (не догоняются)"
+        )
+        self.poll_lag = Gauge("bot_poll_lag_seconds", "Наибольшее опоздание опроса в последнем цикле")
+        self.servers = Gauge("bot_servers", "Серверов под мониторингом")
+        self.publish_queue = Gauge("bot_publish_queue_size", "Снимков в очереди публикации")
+        self.discord_requests = Counter(
+            "bot_discord_requests_total", "REST-запросы к Discord по типу маршрута и результату", ("route", "result")
+        )
+        self.discord_ratelimit_wait = Counter(
+            "bot_discord_ratelimit_wait_seconds_total", "Суммарный Retry-After после ответов 429", ("route",)
+        )
+        self.panel_edits = Counter(
+            "bot_panel_edits_total", "Правки и отправки плашек", ("panel",)
+        )
+        self.panel_edits_skipped = Counter(
+            "bot_panel_edits_skipped_total", "Пропущенные правки плашек: unchanged, rules", ("panel", "reason")
+        )
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus"""
+        lines = []
+        for metric in vars(self).values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+metrics = BotMetrics()
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Минимальный HTTP: GET /metrics отдаёт метрики, остальное — 404"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+            pass  # заголовки не нужны
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError):
+        pass
+    finally:
+        writer.close()
+
+metrics_server = None
+
+async def start_metrics_server():
+    """Запускает эндпоинт метрик (один раз за жизнь процесса)"""
+    global metrics_server
+    if metrics_server is not None or not METRICS_PORT:
+        return
+    try:
+        metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        metrics_log.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        metrics_log.error("Не удалось запустить эндпоинт метрик: %s", e)
+
+# ==================== A2S-КЛИЕНТ ====================
+A2S_HEADER_SIMPLE = b"\xFF\xFF\xFF\xFF"
+A2S_HEADER_SPLIT = b"\xFE\xFF\xFF\xFF"
+A2S_INFO_REQUEST = A2S_HEADER_SIMPLE + b"TSource Engine Query\x00"
+A2S_RESPONSE_CHALLENGE = 0x41
+A2S_RESPONSE_INFO = 0x49
+A2S_RESPONSE_INFO_GOLDSRC = 0x6D
+
+class A2SError(Exception):
+    """Ошибка протокола A2S (битый или неожиданный ответ)"""
+
+class _ByteReader:
+    """Последовательно читает поля из ответа A2S"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def _unpack(self, fmt: str):
+        try:
+            value, = struct.unpack_from(fmt, self.data, self.pos)
+        except struct.error:
+            raise A2SError("Ответ сервера обрезан")
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def byte(self) -> int:
+        return self._unpack("<B")
+
+    def short(self) -> int:
+        return self._unpack("<h")
+
+    def string(self) -> str:
+        end = self.data.find(b"\x00", self.pos)
+        if end == -1:
+            raise A2SError("Строка в ответе не завершена")
+        value = self.data[self.pos:end].decode("utf-8", errors="replace")
+        self.pos = end + 1
+        return value
+
+def parse_a2s_info(payload: bytes) -> dict:
+    """Разбирает ответ A2S_INFO (Source и старый GoldSrc формат)"""
+    reader = _ByteReader(payload)
+    kind = reader.byte()
+
+    if kind == A2S_RESPONSE_INFO:
+        reader.byte()  # версия протокола
+        name = reader.string()
+        map_name = reader.string()
+        reader.string()  # папка игры
+        reader.string()  # название игры
+        reader.short()  # Steam App ID
+        online = reader.byte()
+        max_players = reader.byte()
+    elif kind == A2S_RESPONSE_INFO_GOLDSRC:
+        reader.string()  # адрес
+        name = reader.string()
+        map_name = reader.string()
+        reader.string()  # папка игры
+        reader.string()  # название игры
+        online = reader.byte()
+        max_players = reader.byte()
+    else:
+        raise A2SError(f"Неожиданный тип ответа 0x{kind:02X}")
+
+    return {
+        "online": online,
+        "max": max_players,
+        "name": name,
+        "map": map_name
+    }
+
+class RttEstimator:
+    """Оценка времени ответа сервера как в TCP: сглаженное среднее и отклонение (RFC 6298)"""
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backed_off = None  # удвоенный после таймаута RTO, держится до первого чистого замера (RFC 6298, 5.5)
+        self.stray_until = 0.0  # до этого момента может прийти опоздавший ответ на прошлый запрос
+
+    def update(self, rtt: float):
+        self.backed_off = None
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def rto(self) -> float:
+        """Таймаут одной попытки"""
+        if self.backed_off is not None:
+            return self.backed_off
+        if self.srtt is None:
+            return A2S_INITIAL_RTO
+        return max(A2S_MIN_RTO, min(A2S_TIMEOUT, self.srtt + 4 * self.rttvar))
+
+    def back_off(self, timeout: float):
+        """Попытка не дождалась ответа: следующие запросы начинают с удвоенного таймаута"""
+        self.backed_off = max(A2S_MIN_RTO, min(A2S_TIMEOUT, timeout * 2))
+
+    def attempt_timeouts(self, budget: float) -> list:
+        """Таймауты попыток (каждая вдвое длиннее предыдущей); последняя ждёт до конца бюджета"""
+        rto = self.rto()
+        timeouts = []
+        total = 0.0
+        while len(timeouts) < A2S_MAX_ATTEMPTS and total < budget:
+            attempt = min(rto * 2 ** len(timeouts), budget - total)
+            timeouts.append(attempt)
+            total += attempt
+        # Медленный сервер не должен проигрывать только потому, что попытки кончились раньше бюджета
+        if timeouts and total < budget:
+            timeouts[-1] += budget - total
+        return timeouts
+
+class _A2SQuery:
+    """Состояние одного запроса: future, текущий пакет запроса и собранные фрагменты"""
+
+    def __init__(self, future: asyncio.Future, transport, addr: tuple, timeouts: list):
+        self.future = future
+        self.transport = transport
+        self.addr = addr
+        self.timeouts = timeouts
+        self.request = A2S_INFO_REQUEST
+        self.packet_id = None
+        self.fragments = {}
+        self.attempts = 0
+        self.sent_at = 0.0
+        self.timeout = 0.0
+        self.timer = None
+
+    def send(self):
+        self.sent_at = time.monotonic()
+        self.transport.sendto(self.request, self.addr)
+
+    def feed(self, data: bytes) -> Optional[bytes]:
+        """Принимает датаграмму; возвращает полезную нагрузку, когда ответ собран целиком"""
+        header = data[:4]
+        if header == A2S_HEADER_SIMPLE:
+            return data[4:]
+        if header != A2S_HEADER_SPLIT:
+            raise A2SError("Неизвестный заголовок пакета")
+
+        # Многопакетный ответ (формат Source): id, всего, номер, размер
+        if len(data) < 12:
+            raise A2SError("Заголовок фрагмента обрезан")
+        packet_id, total, number, _size = struct.unpack_from("<LBBh", data, 4)
+        if total == 0 or number >= total:
+            raise A2SError(f"Некорректный фрагмент {number}/{total}")
+
+        if packet_id != self.packet_id:
+            self.packet_id = packet_id
+            self.fragments = {}
+        self.fragments[number] = data[12:]
+        if len(self.fragments) < total:
+            return None
+
+        joined = b"".join(self.fragments[i] for i in range(total))
+        self.fragments = {}
+
+        # Старший бит id означает, что ответ сжат bzip2
+        if packet_id & 0x80000000:
+            if len(joined) < 8:
+                raise A2SError("Сжатый ответ обрезан")
+            size, crc = struct.unpack_from("<LL", joined)
+            try:
+                joined = bz2.decompress(joined[8:])
+            except (OSError, ValueError) as e:
+                raise A2SError(f"Ошибка распаковки ответа: {e}")
+            if len(joined) != size or zlib.crc32(joined) != crc:
+                raise A2SError("Контрольная сумма сжатого ответа не совпала")
+
+        if joined[:4] != A2S_HEADER_SIMPLE:
+            raise A2SError("Неизвестный заголовок собранного ответа")
+        return joined[4:]
+
+class _A2SProtocol(asyncio.DatagramProtocol):
+    """Передаёт входящие датаграммы в A2SClient"""
+
+    def __init__(self, client: "A2SClient"):
+        self.client = client
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.client._on_datagram(data, addr)
+
+    def error_received(self, exc: Exception):
+        # ICMP-ошибки UDP нельзя надёжно сопоставить с запросом, ответ отвалится по таймауту
+        pass
+
+class A2SClient:
+    """Асинхронный A2S-клиент: все запросы идут через один UDP-сокет без потоков"""
+
+    def __init__(self):
+        self._transports = {}  # family -> transport
+        self._pending = {}     # (ip, port) -> _A2SQuery
+        self._resolved = {}    # (host, port) -> (family, addr, expires)
+        self._rtt = {}         # (ip, port) -> RttEstimator
+        self._lock = asyncio.Lock()
+
+    def rtt(self, addr: tuple) -> RttEstimator:
+        """Оценка времени ответа для адреса (ip, port)"""
+        estimator = self._rtt.get(addr)
+        if estimator is None:
+            estimator = self._rtt[addr] = RttEstimator()
+        return estimator
+
+    async def _get_transport(self, family: int):
+        """Возвращает общий UDP-сокет для семейства адресов, создавая его при первом обращении"""
+        transport = self._transports.get(family)
+        if transport is not None and not transport.is_closing():
+            return transport
+
+        async with self._lock:
+            transport = self._transports.get(family)
+            if transport is None or transport.is_closing():
+                local_addr = ("::", 0) if family == socket.AF_INET6 else ("0.0.0.0", 0)
+                loop = asyncio.get_running_loop()
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda: _A2SProtocol(self), local_addr=local_addr, family=family
+                )
+                self._transports[family] = transport
+        return transport
+
+    async def _resolve(self, host: str, port: int) -> tuple:
+        """Превращает host:port в (family, (ip, port)); IP-адреса не резолвятся вовсе"""
+        try:
+            ip = ipaddress.ip_address(host)
+            family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+            return family, (str(ip), port)
+        except ValueError:
+            pass
+
+        cached = self._resolved.get((host, port))
+        if cached and cached[2] > time.monotonic():
+            return cached[0], cached[1]
+
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+        if not infos:
+            raise A2SError(f"Не удалось разрешить адрес {host}")
+        family, _, _, _, sockaddr = infos[0]
+        addr = (sockaddr[0], sockaddr[1])
+        self._resolved[(host, port)] = (family, addr, time.monotonic() + DNS_CACHE_TTL)
+        return family, addr
+
+    async def info(self, host: str, port: int, timeout: float = A2S_TIMEOUT) -> dict:
+        """Отправляет A2S_INFO и ждёт ответ; одновременные запросы к одному адресу объединяются.
+
+        timeout — общий бюджет: внутри него запрос повторяется с таймаутами по RTT сервера.
+        """
+        family, addr = await self._resolve(host, port)
+        query = self._pending.get(addr)
+
+        if query is None:
+            transport = await self._get_transport(family)
+            loop = asyncio.get_running_loop()
+            timeouts = self.rtt(addr).attempt_timeouts(timeout)
+            query = _A2SQuery(loop.create_future(), transport, addr, timeouts)
+            self._pending[addr] = query
+
+            query.future.add_done_callback(lambda _f: self._finish(query))
+            self._attempt(query)
+
+        # shield: отмена одного ожидающего не должна обрывать запрос для остальных
+        return await asyncio.shield(query.future)
+
+    def _attempt(self, query: _A2SQuery):
+        """Отправляет очередную попытку или завершает запрос таймаутом, если попытки кончились"""
+        if query.future.done():
+            return
+        if not query.timeouts:
+            query.future.set_exception(asyncio.TimeoutError(
+                f"Сервер {query.addr[0]}:{query.addr[1]} не ответил за {query.attempts} попыток"
+            ))
+            return
+
+        if query.attempts:
+            # Предыдущая попытка не дождалась ответа
+            self.rtt(query.addr).back_off(query.timeout)
+        query.attempts += 1
+        query.fragments = {}
+        query.send()
+        loop = asyncio.get_running_loop()
+        query.timeout = query.timeouts.pop(0)
+        query.timer = loop.call_later(query.timeout, self._attempt, query)
+
+    def _finish(self, query: _A2SQuery):
+        if query.timer is not None:
+            query.timer.cancel()
+        # Ответы без id: после повторов или таймаута опоздавший ответ может прийти уже на следующий запрос
+        if query.attempts > 1 or query.future.cancelled() or query.future.exception() is not None:
+            estimator = self.rtt(query.addr)
+            estimator.stray_until = max(estimator.stray_until, query.sent_at + A2S_TIMEOUT)
+        if self._pending.get(query.addr) is query:
+            del self._pending[query.addr]
+        if not query.future.cancelled():
+            # Помечаем исключение как полученное, даже если ждать было уже некому
+            query.future.exception()
+
+    def _on_datagram(self, data: bytes, addr: tuple):
+        query = self._pending.get((addr[0], addr[1]))
+        if query is None or query.future.done():
+            return  # опоздавший или чужой пакет
+
+        try:
+            payload = query.feed(data)
+            if payload is None:
+                return  # ждём остальные фрагменты
+
+            if payload[:1] == bytes([A2S_RESPONSE_CHALLENGE]) and len(payload) >= 5:
+                # Сервер требует challenge: повторяем запрос с полученным номером
+                query.request = A2S_INFO_REQUEST + payload[1:5]
+                query.send()
+                return
+
+            data = parse_a2s_info(payload)
+            # Алгоритм Карна: время ответа на повторную отправку не учитываем,
+            # как и ответ, который мог предназначаться прошлому запросу
+            estimator = self.rtt(query.addr)
+            if query.attempts == 1 and query.sent_at >= estimator.stray_until:
+                estimator.update(time.monotonic() - query.sent_at)
+            query.future.set_result(data)
+        except A2SError as e:
+            query.future.set_exception(e)
 
 # ==================== КЭШИРОВАНИЕ ====================
+class CacheEntry:
+    """Запись кэша: последний удачный снимок и время последней ошибки"""
+    __slots__ = ("data", "timestamp", "failed_at")
+
+    def __init__(self):
+        self.data = None
+        self.timestamp = 0.0
+        self.failed_at = 0.0
+
 class QueryCache:
-    """Кэширует запросы к серверам для уменьшения нагрузки"""
+    """Кэширует запросы к серверам для уменьшения нагрузки.
+
+    Размер ограничен (LRU), одновременные запросы к одному ip:port объединяются,
+    ошибки кэшируются ненадолго, а последний удачный снимок можно получить сразу,
+    пока свежие данные запрашиваются в фоне.
+    """
     
-    def __init__(self, ttl=30):
-        self.cache = {}
+    def __init__(self, ttl=30, negative_ttl=10, max_size=1024):
+        self.cache = OrderedDict()  # ip:port -> CacheEntry
+        self.in_flight = {}         # ip:port -> asyncio.Task
         self.ttl = ttl
-    
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+
+    def _entry(self, cache_key: str, create: bool = False) -> Optional[CacheEntry]:
+        entry = self.cache.get(cache_key)
+        if entry is None and create:
+            entry = self.cache[cache_key] = CacheEntry()
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        if entry is not None:
+            self.cache.move_to_end(cache_key)
+        return entry
+
     def get(self, ip: str, port: int) -> Optional[dict]:
         """Получает данные из кэша если они актуальны"""
-        cache_key = f"{ip}:{port}"
-        
-        if cache_key in self.cache:
-            data, timestamp = self.cache[cache_key]
-            if time.time() - timestamp < self.ttl:
-                return data
+        entry = self._entry(f"{ip}:{port}")
+        if entry and entry.data is not None and time.time() - entry.timestamp < self.ttl:
+            return entry.data
+        return None
+
+    def get_stale(self, ip: str, port: int) -> Optional[tuple]:
+        """Возвращает последний удачный снимок (data, timestamp) независимо от возраста"""
+        entry = self._entry(f"{ip}:{port}")
+        if entry and entry.data is not None:
+            return entry.data, entry.timestamp
         return None
+
+    def is_failed(self, ip: str, port: int) -> bool:
+        """Проверяет, закэширована ли недавняя ошибка запроса"""
+        entry = self._entry(f"{ip}:{port}")
+        return bool(entry and entry.failed_at > entry.timestamp
+                    and time.time() - entry.failed_at < self.negative_ttl)
     
     def set(self, ip: str, port: int, data: dict):
         """Сохраняет данные в кэш"""
+        entry = self._entry(f"{ip}:{port}", create=True)
+        entry.data = data
+        entry.timestamp = time.time()
+
+    def set_failed(self, ip: str, port: int):
+        """Запоминает неудачный запрос, чтобы не повторять его сразу"""
+        entry = self._entry(f"{ip}:{port}", create=True)
+        entry.failed_at = time.time()
+
+    async def fetch(self, ip: str, port: int, fetcher, allow_stale: bool = False,
+                    use_negative: bool = True) -> Optional[dict]:
+        """Возвращает данные из кэша или запрашивает их через fetcher(ip, port).
+
+        С allow_stale устаревший снимок возвращается сразу, а обновление идёт в фоне.
+        С use_negative=False недавняя ошибка не мешает отправить новый запрос.
+        """
+        data = self.get(ip, port)
+        if data is not None:
+            metrics.cache_requests.inc(result="hit")
+            cache_log.debug("Использую кэш для %s:%s", ip, port)
+            return data
+
+        stale = self.get_stale(ip, port) if allow_stale else None
+        if use_negative and self.is_failed(ip, port):
+            metrics.cache_requests.inc(result="negative")
+            return stale[0] if stale else None
+
+        task = self._refresh(ip, port, fetcher)
+        if stale:
+            metrics.cache_requests.inc(result="stale")
+            return stale[0]
+        metrics.cache_requests.inc(result="miss")
+        # shield: отмена одного ожидающего не должна обрывать общий запрос
+        return await asyncio.shield(task)
+
+    def _refresh(self, ip: str, port: int, fetcher) -> asyncio.Task:
+        """Запускает запрос к серверу или возвращает уже идущий"""
         cache_key = f"{ip}:{port}"
-        self.cache[cache_key] = (data, time.time())
+        task = self.in_flight.get(cache_key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._run_fetcher(ip, port, fetcher))
+            self.in_flight[cache_key] = task
+            task.add_done_callback(lambda _t: self.in_flight.pop(cache_key, None))
+        return task
+
+    async def _run_fetcher(self, ip: str, port: int, fetcher) -> Optional[dict]:
+        data = None
+        try:
+            data = await fetcher(ip, port)
+        finally:
+            if data is None:
+                self.set_failed(ip, port)
+            else:
+                self.set(ip, port, data)
+        return data
     
     def clear(self):
         """Очищает кэш"""
         self.cache.clear()
 
 # Создаем глобальный кэш
-cache = QueryCache(ttl=30)
+cache = QueryCache(ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL, max_size=CACHE_MAX_SIZE)
+
+# ==================== СОСТОЯНИЕ ====================
+class StateStore:
+    """Компактное хранилище часто меняющегося состояния (SQLite, запись по отдельному ключу)"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS runtime_state ("
+            " scope TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT,"
+            " PRIMARY KEY (scope, key)"
+            ") WITHOUT ROWID"
+        )
+
+    def get_scope(self, scope: str) -> dict:
+        """Возвращает все значения области (например, server:1)"""
+        try:
+            rows = self.db.execute("SELECT key, value FROM runtime_state WHERE scope = ?", (scope,))
+            return {key: json.loads(value) for key, value in rows}
+        except (sqlite3.Error, ValueError) as e:
+            state_log.error("Ошибка чтения %s: %s", scope, e)
+            return {}
+
+    def get(self, scope: str, key: str, default=None):
+        return self.get_scope(scope).get(key, default)
+
+    def scopes(self, prefix: str) -> list:
+        """Возвращает все области, начинающиеся с prefix"""
+        try:
+            rows = self.db.execute(
+                "SELECT DISTINCT scope FROM runtime_state WHERE substr(scope, 1, ?) = ?",
+                (len(prefix), prefix)
+            )
+            return [scope for scope, in rows]
+        except sqlite3.Error as e:
+            state_log.error("Ошибка чтения областей %s: %s", prefix, e)
+            return []
+
+    def set(self, scope: str, key: str, value):
+        """Записывает одно значение, не трогая остальные"""
+        try:
+            self.db.execute(
+                "INSERT INTO runtime_state (scope, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(scope, key) DO UPDATE SET value = excluded.value",
+                (scope, key, json.dumps(value, ensure_ascii=False))
+            )
+        except sqlite3.Error as e:
+            state_log.error("Ошибка записи %s/%s: %s", scope, key, e)
+
+    def delete(self, scope: str):
+        """Удаляет все значения области"""
+        try:
+            self.db.execute("DELETE FROM runtime_state WHERE scope = ?", (scope,))
+        except sqlite3.Error as e:
+            state_log.error("Ошибка удаления %s: %s", scope, e)
+
+    def close(self):
+        self.db.close()
+
+# ==================== СТАТИСТИКА ====================
+class StatsStore:
+    """Готовые сводки по дням и неделям (SQLite), обновляемые с каждым опросом.
+
+    Команда статистики читает одну строку сводки и 24 строки по часам,
+    а не сырые замеры, поэтому год истории отвечает так же быстро, как час.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS stats_rollup ("
+            " server_id INTEGER NOT NULL,"
+            " period TEXT NOT NULL,"          # day:2024-05-01 или week:2024-W18
+            " samples INTEGER NOT NULL,"      # удачных опросов
+            " online_sum INTEGER NOT NULL,"
+            " peak INTEGER NOT NULL,"
+            " max_players INTEGER NOT NULL,"
+            " up_seconds REAL NOT NULL,"      # время, когда сервер отвечал
+            " observed_seconds REAL NOT NULL,"
+            " PRIMARY KEY (server_id, period)"
+            ") WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS stats_hourly ("
+            " server_id INTEGER NOT NULL,"
+            " period TEXT NOT NULL,"
+            " hour INTEGER NOT NULL,"         # час суток 0-23
+            " samples INTEGER NOT NULL,"
+            " online_sum INTEGER NOT NULL,"
+            " PRIMARY KEY (server_id, period, hour)"
+            ") WITHOUT ROWID"
+        )
+        self._last_seen = {}   # server_id -> time.time() предыдущего опроса
+        self._pending = []     # (server_id, period, hour, online, max, up, seconds) до flush()
+
+    @staticmethod
+    def periods(moment: datetime) -> tuple:
+        """Ключи дня и недели, в которые попадает момент"""
+        year, week, _ = moment.isocalendar()
+        return f"day:{moment:%Y-%m-%d}", f"week:{year}-W{week:02d}"
+
+    def record(self, server_id: int, data: Optional[dict], now: Optional[float] = None):
+        """Учитывает результат опроса; data=None — сервер не ответил"""
+        now = time.time() if now is None else now
+        previous = self._last_seen.get(server_id)
+        self._last_seen[server_id] = now
+        # Время с прошлого опроса засчитывается состоянию, которое увидели сейчас
+        seconds = min(now - previous, STATS_MAX_GAP) if previous is not None else 0.0
+
+        moment = datetime.fromtimestamp(now)
+        for period in self.periods(moment):
+            self._pending.append((server_id, period, moment.hour, data, seconds))
+
+    def flush(self):
+        """Записывает накопленные опросы одной транзакцией"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+
+        rollups = []
+        hourly = []
+        for server_id, period, hour, data, seconds in pending:
+            if data:
+                rollups.append((server_id, period, 1, data["online"], data["online"], data["max"], seconds, seconds))
+                hourly.append((server_id, period, hour, 1, data["online"]))
+            else:
+                rollups.append((server_id, period, 0, 0, 0, 0, 0.0, seconds))
+
+        # isolation_level=None: транзакцию открываем сами, иначе каждая строка коммитится отдельно
+        try:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT INTO stats_rollup (server_id, period, samples, online_sum, peak, max_players,"
+                " up_seconds, observed_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(server_id, period) DO UPDATE SET"
+                " samples = samples + excluded.samples,"
+                " online_sum = online_sum + excluded.online_sum,"
+                " peak = max(peak, excluded.peak),"
+                " max_players = max(max_players, excluded.max_players),"
+                " up_seconds = up_seconds + excluded.up_seconds,"
+                " observed_seconds = observed_seconds + excluded.observed_seconds",
+                rollups
+            )
+            self.db.executemany(
+                "INSERT INTO stats_hourly (server_id, period, hour, samples, online_sum) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(server_id, period, hour) DO UPDATE SET"
+                " samples = samples + excluded.samples,"
+                " online_sum = online_sum + excluded.online_sum",
+                hourly
+            )
+            self.db.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            stats_log.error("Ошибка записи статистики: %s", e)
+
+    def get(self, server_id: int, period: str) -> Optional[dict]:
+        """Готовая сводка за период: пик, средний онлайн, аптайм и средний онлайн по часам"""
+        try:
+            row = self.db.execute(
+                "SELECT samples, online_sum, peak, max_players, up_seconds, observed_seconds "
+                "FROM stats_rollup WHERE server_id = ? AND period = ?",
+                (server_id, period)
+            ).fetchone()
+            if row is None:
+                return None
+            hours = self.db.execute(
+                "SELECT hour, samples, online_sum FROM stats_hourly WHERE server_id = ? AND period = ?",
+                (server_id, period)
+            ).fetchall()
+        except sqlite3.Error as e:
+            stats_log.error("Ошибка чтения статистики #%s %s: %s", server_id, period, e)
+            return None
+
+        samples, online_sum, peak, max_players, up_seconds, observed_seconds = row
+        by_hour = [None] * 24
+        for hour, hour_samples, hour_sum in hours:
+            by_hour[hour] = hour_sum / hour_samples
+        return {
+            "peak": peak,
+            "avg": online_sum / samples if samples else 0.0,
+            "max": max_players,
+            "uptime": up_seconds / observed_seconds * 100 if observed_seconds else (100.0 if samples else 0.0),
+            "samples": samples,
+            "by_hour": by_hour
+        }
+
+    def delete_server(self, server_id: int):
+        """Удаляет статистику сервера"""
+        self._last_seen.pop(server_id, None)
+        self._pending = [item for item in self._pending if item[0] != server_id]
+        try:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM stats_rollup WHERE server_id = ?", (server_id,))
+            self.db.execute("DELETE FROM stats_hourly WHERE server_id = ?", (server_id,))
+            self.db.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            stats_log.error("Ошибка удаления статистики #%s: %s", server_id, e)
+
+    def close(self):
+        self.flush()
+        self.db.close()
 
 # ==================== КЛАСС ДАННЫХ ====================
 class ServerConfig:
-    def __init__(self):
+    # Поля, которые меняет сам бот: хранятся в StateStore, а не в config.json
+    RUNTIME_FIELDS = ("last_online", "message_id")
+
+    def __init__(self, state: StateStore):
         self.servers = {}
+        self.state = state
+        self.dirty = False
+        self.version = 0         # растёт при каждом добавлении и удалении сервера
+        self._view = None
+        self._view_version = -1
         self.load_config()
+
+    def view(self) -> MappingProxyType:
+        """Неизменяемый снимок набора серверов (server_id -> настройки) текущей версии.
+
+        Команды могут добавлять и удалять серверы, пока цикл опроса ждёт ответов:
+        цикл работает со своим снимком, а удалённые серверы проверяет по config.servers.
+        """
+        if self._view_version != self.version:
+            self._view = MappingProxyType(dict(self.servers))
+            self._view_version = self.version
+        return self._view
     
     def load_config(self):
         """Загружает конфигурацию и добавляет недостающие поля"""
         if not os.path.exists(CONFIG_FILE):
-            print("[CONFIG] Файл конфигурации не найден, будет создан новый.")
+            config_log.info("Файл конфигурации не найден, будет создан новый")
             self.servers = {}
             return
 
@@ -80,39 +1027,91 @@ class ServerConfig:
                     "thumbnail_url": None,
                     "footer_text": "Обновлено",
                     "design": "old",
-                    "image_url": None
+                    "image_url": None,
+                    "voice_bucket": 1,
+                    "shared_panel": False,
+                    "min_delta": 1,
+                    "edit_on_bar_change": False,
+                    "min_edit_interval": 0,
+                    "max_staleness": PANEL_MAX_STALENESS,
+                    "show_chart": False
                 }
 
                 for server_id, server in self.servers.items():
+                    # Переносим runtime-поля из старого config.json в хранилище состояния
+                    runtime = self.state.get_scope(f"server:{server_id}")
+                    for key in self.RUNTIME_FIELDS:
+                        if key in server:
+                            if key not in runtime:
+                                self.state.set(f"server:{server_id}", key, server[key])
+                                runtime[key] = server[key]
+                            self.dirty = True
+                    server.update(runtime)
+
                     for key, default_value in defaults.items():
                         if key not in server:
                             server[key] = default_value
-                            print(f"[CONFIG] Добавлено поле '{key}' для сервера #{server_id}")
+                            if key not in self.RUNTIME_FIELDS:
+                                config_log.debug("Добавлено поле '%s' для сервера #%s", key, server_id)
 
-            print(f"[CONFIG] Загружено {len(self.servers)} серверов")
+            config_log.info("Загружено %d серверов", len(self.servers))
 
         except Exception as e:
-            print(f"[CONFIG] Ошибка загрузки: {e}")
+            config_log.error("Ошибка загрузки: %s", e)
             self.servers = {}
     
+    def flush(self):
+        """Записывает конфигурацию, только если есть несохранённые изменения (перенос runtime-полей)"""
+        if self.dirty:
+            self.save_config()
+
     def save_config(self):
-        """Сохраняет конфигурацию в файл"""
+        """Сразу и атомарно сохраняет конфигурацию в файл (временный файл + переименование)"""
+        tmp_file = f"{CONFIG_FILE}.tmp"
         try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.servers, f, indent=4, ensure_ascii=False)
-            print(f"[CONFIG] Конфигурация сохранена ({len(self.servers)} серверов)")
+            settings = {
+                server_id: {k: v for k, v in server.items() if k not in self.RUNTIME_FIELDS}
+                for server_id, server in self.servers.items()
+            }
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(settings, f, indent=4, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, CONFIG_FILE)
+            self.dirty = False
+            config_log.debug("Конфигурация сохранена (%d серверов)", len(self.servers))
         except Exception as e:
-            print(f"[CONFIG] Ошибка сохранения: {e}")
+            config_log.error("Ошибка сохранения: %s", e)
     
+    def set_runtime(self, server_id: int, key: str, value):
+        """Меняет runtime-поле сервера; пишется только этот ключ, config.json не трогается"""
+        server = self.servers.get(server_id)
+        if server is None:
+            return
+        if isinstance(value, tuple):
+            value = list(value)
+        if server.get(key) == value:
+            return
+        server[key] = value
+        self.state.set(f"server:{server_id}", key, value)
+
+    def remove_server(self, server_id: int):
+        """Удаляет сервер вместе с его runtime-состоянием"""
+        self.servers.pop(server_id, None)
+        self.version += 1
+        self.state.delete(f"server:{server_id}")
+        self.save_config()
+
     def add_server(self, ip: str, port: int, name: str, display_port: Optional[int] = None) -> Optional[int]:
         """Добавляет новый сервер и возвращает его ID"""
         for existing_id, server in self.servers.items():
             if server["ip"] == ip and server["port"] == port:
-                print(f"[CONFIG] Сервер {ip}:{port} уже существует (ID: {existing_id})")
+                config_log.warning("Сервер %s:%s уже существует (ID: %s)", ip, port, existing_id)
                 return None
         
         new_id = max(self.servers.keys(), default=0) + 1
         
+        self.state.delete(f"server:{new_id}")
         self.servers[new_id] = {
             "ip": ip,
             "port": port,
@@ -131,14 +1130,31 @@ class ServerConfig:
             "thumbnail_url": None,
             "footer_text": "Обновлено",
             "design": "old",
-            "image_url": None
+            "image_url": None,
+            "voice_bucket": 1,
+            "shared_panel": False,
+            "min_delta": 1,
+            "edit_on_bar_change": False,
+            "min_edit_interval": 0,
+            "max_staleness": PANEL_MAX_STALENESS,
+            "show_chart": False
         }
+        self.version += 1
         
         self.save_config()
-        print(f"[CONFIG] Добавлен сервер #{new_id}: {name} ({ip}:{port})")
+        config_log.info("Добавлен сервер #%s: %s (%s:%s)", new_id, name, ip, port)
         return new_id
 
 # Функции для создания embed
+PROGRESS_BAR_LENGTH = {"old": 10, "new": 15}
+
+def progress_filled(server: dict, data: dict) -> Optional[int]:
+    """Сколько делений прогресс-бара закрашено в дизайне сервера (None — бара на плашке нет)"""
+    if not server.get("show_progress", True) or data.get("offline") or data["max"] <= 0:
+        return None
+    bar_length = PROGRESS_BAR_LENGTH.get(server.get("design", "old"), PROGRESS_BAR_LENGTH["old"])
+    return int(bar_length * (data["online"] / data["max"]))
+
 def create_old_embed(server_id: int, server: dict, data: dict) -> discord.Embed:
     """Создает embed в старом стиле (компактный) без карты"""
     title = server["embed_title"]
@@ -155,7 +1171,7 @@ def create_old_embed(server_id: int, server: dict, data: dict) -> discord.Embed:
     if server.get("show_progress", True):
         if data["max"] > 0:
             percentage = (data["online"] / data["max"]) * 100
-            bar_length = 10
+            bar_length = PROGRESS_BAR_LENGTH["old"]
             filled = int(bar_length * (data["online"] / data["max"]))
             progress_bar = "█" * filled + "░" * (bar_length - filled)
             embed.add_field(name="👥 Онлайн", value=f"**{data['online']}**/{data['max']}", inline=True)
@@ -178,8 +1194,8 @@ def create_old_embed(server_id: int, server: dict, data: dict) -> discord.Embed:
     
     return embed
 
-def create_new_embed(server_id: int, server: dict, data: dict) -> discord.Embed:
-    """Создает вертикальный embed без карты"""
+def create_new_embed(server_id: int, server: dict, data: dict, chart: Optional[tuple] = None) -> discord.Embed:
+    """Создает вертикальный embed без карты; chart — приложенный график онлайна (имя файла, PNG)"""
     
     # Выбираем цвет embed
     if data["online"] == 0:
@@ -208,16 +1224,18 @@ def create_new_embed(server_id: int, server: dict, data: dict) -> discord.Embed:
     
     if server.get("show_progress", True) and data["max"] > 0:
         percentage = (data["online"] / data["max"]) * 100
-        bar_length = 15
+        bar_length = PROGRESS_BAR_LENGTH["new"]
         filled = int(bar_length * (data["online"] / data["max"]))
         progress_bar = "█" * filled + "░" * (bar_length - filled)
         online_value += f"\n`{progress_bar}` {percentage:.1f}%"
     
     embed.add_field(name="👥 Онлайн", value=online_value, inline=False)
     
-    # Большое изображение на всю ширину
+    # Большое изображение на всю ширину: график онлайна или картинка из настроек
     image_url = server.get("image_url") or server.get("thumbnail_url")
-    if image_url:
+    if chart:
+        embed.set_image(url=f"attachment://{chart[0]}")
+    elif image_url:
         embed.set_image(url=image_url)
     
     # Футер с текстом "Обновлено" и временем
@@ -225,228 +1243,1641 @@ def create_new_embed(server_id: int, server: dict, data: dict) -> discord.Embed:
     
     return embed
 
+def create_offline_embed(server_id: int, server: dict, data: dict) -> discord.Embed:
+    """Создает embed для недоступного сервера (по состоянию circuit breaker)"""
+    embed = discord.Embed(
+        title=f"🔴 {server['name']}",
+        description="Сервер не отвечает на запросы",
+        color=0x808080,
+        timestamp=datetime.now()
+    )
+
+    display_port = server.get("display_port", server["port"])
+    embed.add_field(name="🌐 Адрес", value=f"{server['ip']}:{display_port}", inline=False)
+    embed.add_field(name="⏱️ Недоступен с", value=f"<t:{int(data['since'])}:R>", inline=False)
+
+    footer_text = server.get("footer_text", "Обновлено")
+    embed.set_footer(text=f"{footer_text} • 🆔: {server_id}")
+
+    return embed
+
+def create_server_embed(server_id: int, server: dict, data: dict, chart: Optional[tuple] = None) -> discord.Embed:
+    """Создает embed плашки в выбранном для сервера дизайне"""
+    if data.get("offline"):
+        return create_offline_embed(server_id, server, data)
+    if server.get("design", "old") == "new":
+        return create_new_embed(server_id, server, data, chart)
+    return create_old_embed(server_id, server, data)
+
 # ==================== ИНИЦИАЛИЗАЦИЯ ====================
 intents = discord.Intents.default()
-client = discord.Client(intents=intents)
+client = discord.Client(intents=intents, max_ratelimit_timeout=DISCORD_MAX_RATELIMIT_WAIT)
 tree = app_commands.CommandTree(client)
-config = ServerConfig()
+# Открываются в initialize(): процессы пула графиков импортируют модуль заново
+state_store: Optional[StateStore] = None
+stats_store: Optional[StatsStore] = None
+config: Optional[ServerConfig] = None
+a2s_client = A2SClient()
+a2s_semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+
+def initialize():
+    """Запускает логирование, открывает базу состояния и загружает конфигурацию"""
+    global state_store, stats_store, config
+    setup_logging()
+    state_store = StateStore(STATE_DB_FILE)
+    stats_store = StatsStore(STATE_DB_FILE)
+    config = ServerConfig(state_store)
+
+# ==================== ИСХОДЯЩИЕ ЗАПРОСЫ К DISCORD ====================
+PRIORITY_INTERACTION = 0  # Ответы на команды
+PRIORITY_PANEL = 1        # Правки плашек
+PRIORITY_RENAME = 2       # Переименования голосовых каналов
+
+class DiscordRequestExpired(Exception):
+    """Запрос пролежал в очереди дольше своего срока и был отброшен"""
+
+class DiscordRequestDropped(DiscordRequestExpired):
+    """Сервер удалили, пока запрос публикации ждал в очереди, — запрос отброшен"""
+
+# Маршрут запроса, который сейчас выполняет планировщик (у каждой задачи _execute — свой)
+current_route = contextvars.ContextVar("current_route", default=None)
+
+class RateLimitWaitFilter(logging.Filter):
+    """Замечает 429, которые discord.py переждал сам, не вернув ошибку планировщику.
+
+    Короткий Retry-After библиотека отсыпает внутри запроса и сообщает о нём только в лог discord.http.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        route = current_route.get()
+        message = str(record.msg)
+        if route is not None and "responded with 429" in message and "Retrying in" in message and record.args:
+            discord_scheduler.rate_limited(route, float(record.args[-1]))
+        return True
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду с запасом до capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # после 429 маршрут закрыт до этого момента
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд можно выполнить запрос (0 — можно сейчас)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+class _DiscordRequest:
+    """Запрос в очереди планировщика"""
+    __slots__ = ("priority", "seq", "route", "factory", "deadline", "future", "retries", "max_retries")
+
+    def __init__(self, priority: int, seq: int, route: str, factory, deadline: Optional[float], future,
+                 max_retries: int = DISCORD_MAX_RETRIES):
+        self.priority = priority
+        self.seq = seq
+        self.route = route
+        self.factory = factory
+        self.deadline = deadline
+        self.future = future
+        self.retries = 0
+        self.max_retries = max_retries
+
+    def __lt__(self, other: "_DiscordRequest") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class DiscordScheduler:
+    """Единая очередь REST-запросов бота: приоритеты, лимиты по маршрутам, отбрасывание устаревших"""
+
+    def __init__(self):
+        self._queue = []    # куча _DiscordRequest
+        self._buckets = {}  # маршрут -> TokenBucket
+        self._global = TokenBucket(DISCORD_GLOBAL_RATE, DISCORD_GLOBAL_BURST)
+        self._seq = itertools.count()
+        self._slots = asyncio.Semaphore(DISCORD_MAX_IN_FLIGHT)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._tasks = set()
+
+    def _bucket(self, route: str) -> TokenBucket:
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            rate, capacity = DISCORD_ROUTE_LIMITS.get(route.split(":", 1)[0], (1.0, 5))
+            bucket = self._buckets[route] = TokenBucket(rate, capacity)
+        return bucket
+
+    def rate_limited(self, route: str, retry_after: float):
+        """Учитывает 429 в метриках и закрывает маршрут до Retry-After"""
+        metrics.discord_ratelimit_wait.inc(retry_after, route=route.split(":", 1)[0])
+        self._bucket(route).blocked_until = time.monotonic() + retry_after
+
+    def _retry_later(self, request: _DiscordRequest, retry_after: float):
+        # ✅ ВАЖНО: Никто не спит — маршрут закрывается до Retry-After, запрос возвращается в очередь
+        self.rate_limited(request.route, retry_after)
+        request.retries += 1
+        heapq.heappush(self._queue, request)
+        self._wakeup.set()
+        discord_log.warning("Rate limit на %s, повтор через %.1fс", request.route, retry_after)
+
+    async def submit(self, route: str, factory, priority: int = PRIORITY_PANEL, deadline: Optional[float] = None,
+                     max_retries: int = DISCORD_MAX_RETRIES):
+        """Ставит запрос в очередь и ждёт его результат.
+
+        factory — функция без аргументов, возвращающая корутину запроса; route — ключ лимита
+        (например, message:<id канала>); deadline — time.monotonic(), после которого запрос не нужен.
+        Когда max_retries повторов после 429 исчерпаны, поднимается discord.RateLimited (долгий Retry-After)
+        или discord.HTTPException со статусом 429.
+        """
+        loop = asyncio.get_running_loop()
+        request = _DiscordRequest(priority, next(self._seq), route, factory, deadline, loop.create_future(),
+                                  max_retries)
+        heapq.heappush(self._queue, request)
+
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        self._wakeup.set()
+        return await request.future
+
+    def _next_ready(self, now: float) -> tuple:
+        """Самый приоритетный запрос со свободным маршрутом, иначе — сколько ждать до ближайшего"""
+        ready = None
+        wait = None
+        deferred = []
+        global_delay = self._global.delay(now)
+
+        while self._queue:
+            request = heapq.heappop(self._queue)
+            if request.future.done():
+                continue  # ожидающий отменил запрос
+            if request.deadline is not None and now > request.deadline:
+                request.future.set_exception(DiscordRequestExpired(f"Запрос {request.route} устарел"))
+                continue
+
+            delay = max(global_delay, self._bucket(request.route).delay(now))
+            if delay <= 0:
+                ready = request
+                break
+            deferred.append(request)
+            wait = delay if wait is None else min(wait, delay)
+
+        for request in deferred:
+            heapq.heappush(self._queue, request)
+
+        if ready is not None:
+            self._global.consume()
+            self._bucket(ready.route).consume()
+        return ready, wait
+
+    async def _dispatch(self):
+        while True:
+            request, wait = self._next_ready(time.monotonic())
+            if request is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            task = asyncio.get_running_loop().create_task(self._execute(request))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, request: _DiscordRequest):
+        route_kind = request.route.split(":", 1)[0]
+        current_route.set(request.route)
+        try:
+            result = await request.factory()
+        except discord.RateLimited as e:
+            # Retry-After длиннее DISCORD_MAX_RATELIMIT_WAIT: discord.py не стал ждать сам
+            metrics.discord_requests.inc(route=route_kind, result="429")
+            if request.retries < request.max_retries and not request.future.done():
+                self._retry_later(request, e.retry_after)
+            else:
+                # Повторов больше нет, но маршрут всё равно закрыт до Retry-After
+                self.rate_limited(request.route, e.retry_after)
+                if not request.future.done():
+                    request.future.set_exception(e)
+        except discord.HTTPException as e:
+            metrics.discord_requests.inc(route=route_kind, result=str(e.status))
+            headers = getattr(e.response, "headers", None) or {}
+            if e.status == 429 and request.retries < request.max_retries and not request.future.done():
+                self._retry_later(request, float(headers.get('Retry-After', 5)))
+            else:
+                if e.status == 429:
+                    self.rate_limited(request.route, float(headers.get('Retry-After', 5)))
+                if not request.future.done():
+                    request.future.set_exception(e)
+        except Exception as e:
+            metrics.discord_requests.inc(route=route_kind, result="error")
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            metrics.discord_requests.inc(route=route_kind, result="ok")
+            if not request.future.done():
+                request.future.set_result(result)
+        finally:
+            self._slots.release()
+
+discord_scheduler = DiscordScheduler()
+logging.getLogger("discord.http").addFilter(RateLimitWaitFilter())
+
+async def send_followup(interaction: discord.Interaction, *args, **kwargs):
+    """Отправляет follow-up ответа на команду через общую очередь с наивысшим приоритетом"""
+    return await discord_scheduler.submit(
+        f"interaction:{interaction.id}",
+        lambda: interaction.followup.send(*args, **kwargs),
+        PRIORITY_INTERACTION
+    )
+
+async def edit_response(interaction: discord.Interaction, **kwargs):
+    """Правит исходный ответ на команду через общую очередь с наивысшим приоритетом"""
+    return await discord_scheduler.submit(
+        f"interaction:{interaction.id}",
+        lambda: interaction.edit_original_response(**kwargs),
+        PRIORITY_INTERACTION
+    )
+
+# ==================== ПРАВИЛА ОБНОВЛЕНИЯ ПЛАШЕК ====================
+class PanelThrottle:
+    """Решает, какой снимок показывать на плашке: свежий или прежний (гистерезис и интервалы правок)"""
+
+    def __init__(self):
+        # server_id -> (снимок на плашке, когда он был показан)
+        self.shown = {}
+        # server_id -> когда плашку сервера последний раз действительно отправили или отредактировали
+        self.edited = {}
+
+    @staticmethod
+    def _visible(data: dict) -> tuple:
+        return (bool(data.get("offline")), data["online"], data["max"])
+
+    def choose(self, server_id: int, server: dict, data: dict, now: float, force: bool = False) -> dict:
+        """Свежий снимок, если правило сервера разрешает правку, иначе уже показанный"""
+        previous = self.shown.get(server_id)
+        if force or previous is None:
+            return data
+
+        shown, shown_at = previous
+        age = now - shown_at
+        if self._visible(shown) == self._visible(data):
+            return data
+        # Дольше max_staleness устаревшие данные не показываем, что бы ни говорили остальные правила
+        if age >= server.get("max_staleness", PANEL_MAX_STALENESS):
+            return data
+        # Сервер упал/поднялся или сменился слот — это видно сразу, даже внутри min_edit_interval:
+        # снимок офлайна ставится в очередь один раз, удержанный он так и не попал бы на плашку
+        if bool(shown.get("offline")) != bool(data.get("offline")) or shown["max"] != data["max"]:
+            return data
+        # Интервал между правками считается от последней настоящей правки, а не от последнего опроса
+        if now - self.edited.get(server_id, float("-inf")) < server.get("min_edit_interval", 0):
+            return shown
+        if abs(data["online"] - shown["online"]) >= server.get("min_delta", 1):
+            return data
+        if server.get("edit_on_bar_change") and progress_filled(server, shown) != progress_filled(server, data):
+            return data
+        return shown
+
+    def mark_shown(self, server_id: int, data: dict, now: float):
+        """Запоминает снимок, который теперь на плашке (прежний снимок не сбрасывает время)"""
+        previous = self.shown.get(server_id)
+        if previous is None or previous[0] is not data:
+            self.shown[server_id] = (data, now)
+
+    def mark_edited(self, server_id: int, data: dict, now: float):
+        """Запоминает снимок, с которым плашку только что отправили или отредактировали"""
+        self.mark_shown(server_id, data, now)
+        self.edited[server_id] = now
+
+    def forget(self, server_id: int):
+        self.shown.pop(server_id, None)
+        self.edited.pop(server_id, None)
+
+panel_throttle = PanelThrottle()
 
 # ==================== ОСНОВНЫЕ ФУНКЦИИ ====================
-async def get_server_info(ip: str, port: int) -> Optional[dict]:
-    """Получает информацию о сервере с использованием кэша"""
-    cached_data = cache.get(ip, port)
-    if cached_data:
-        print(f"[CACHE] Использую кэш для {ip}:{port}")
-        return cached_data
-    
+async def query_server(ip: str, port: int) -> Optional[dict]:
+    """Выполняет A2S запрос к серверу в обход кэша"""
+    started = time.monotonic()
     try:
-        info = await client.loop.run_in_executor(
-            None, a2s.info, (ip, port), 5.0
-        )
-        data = {
-            "online": info.player_count,
-            "max": info.max_players,
-            "name": info.server_name,
-            "map": info.map_name
-        }
-        
-        cache.set(ip, port, data)
-        print(f"[CACHE] Сохранил в кэш {ip}:{port} - {data['online']}/{data['max']}")
+        data = await a2s_client.info(ip, port, A2S_TIMEOUT)
+        metrics.a2s_latency.observe(time.monotonic() - started, server=f"{ip}:{port}")
+        cache_log.debug("Сохранил в кэш %s:%s - %s/%s", ip, port, data["online"], data["max"])
         return data
-        
+
     except Exception as e:
-        print(f"[A2S] Ошибка запроса к {ip}:{port}: {e}")
+        metrics.a2s_failures.inc(server=f"{ip}:{port}")
+        a2s_log.info("Ошибка запроса к %s:%s: %s", ip, port, e)
         return None
 
-async def find_bot_message(channel: discord.TextChannel) -> Optional[discord.Message]:
-    """Ищет последнее сообщение от бота с embed в канале"""
-    try:
+async def get_server_info(ip: str, port: int, allow_stale: bool = False,
+                          use_negative: bool = True) -> Optional[dict]:
+    """Получает информацию о сервере с использованием кэша"""
+    return await cache.fetch(ip, port, query_server, allow_stale=allow_stale, use_negative=use_negative)
+
+async def find_bot_message(channel: discord.TextChannel, priority: int = PRIORITY_PANEL,
+                           deadline: Optional[float] = None) -> Optional[discord.Message]:
+    """Ищет последнее сообщение от бота с embed в канале, не занятое другой плашкой"""
+    taken = known_panel_messages(channel.id)
+
+    async def scan():
         async for message in channel.history(limit=15):
-            if message.author == client.user and len(message.embeds) > 0:
+            if message.author == client.user and len(message.embeds) > 0 and message.id not in taken:
                 return message
+        return None
+
+    try:
+        return await discord_scheduler.submit(f"message:{channel.id}", scan, priority, deadline)
+    except DiscordRequestExpired:
+        raise
     except Exception as e:
-        print(f"[FIND] Ошибка поиска сообщений: {e}")
+        update_log.warning("Ошибка поиска сообщений: %s", e)
     return None
 
-async def update_text_embed(server_id: int, data: dict):
+def embed_fingerprint(embed: discord.Embed) -> str:
+    """Хэш видимого содержимого embed: заголовок, цвет, все поля, подвал и картинки (без времени)"""
+    color = embed.color.value if isinstance(embed.color, discord.Colour) else embed.color
+    content = {
+        "title": embed.title,
+        "description": embed.description,
+        "color": color,
+        "fields": [(field.name, field.value, field.inline) for field in embed.fields],
+        "footer": embed.footer.text,
+        "image": embed.image.url,
+        "thumbnail": embed.thumbnail.url
+    }
+    raw = json.dumps(content, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+# Отпечатки последних опубликованных плашек: server_id -> хэш embed
+published_embeds = {}
+# Отпечатки общих плашек: panel:<канал>:<номер> -> хэш всех embed сообщения
+published_panels = {}
+# Последний снимок каждого сервера — из них собираются общие плашки
+last_snapshots = {}
+
+def while_listed(server_ids, factory):
+    """Оборачивает запрос публикации: перед отправкой проверяет, что серверы ещё не удалены.
+
+    /server_remove убирает плашки в фоне; запрос, уже стоящий в очереди, иначе оставил бы сообщение-сироту.
+    """
+    def guarded():
+        removed = [server_id for server_id in server_ids if server_id not in config.servers]
+        if removed:
+            raise DiscordRequestDropped(f"Серверы {removed} удалены")
+        return factory()
+    return guarded
+
+async def send_or_edit_embed(channel: discord.TextChannel, server_id: int, message, embed: discord.Embed,
+                             priority: int = PRIORITY_PANEL, deadline: Optional[float] = None,
+                             charts: list = ()):
+    """Редактирует плашку; если сообщение удалено — берёт другое сообщение бота или отправляет новое"""
+    route = f"message:{channel.id}"
+
+    if message:
+        try:
+            await discord_scheduler.submit(
+                route,
+                while_listed([server_id], lambda: message.edit(embed=embed, **chart_kwargs(message.id, charts))),
+                priority, deadline
+            )
+            remember_charts(message.id, charts)
+            return message
+        except discord.NotFound:
+            update_log.info("Сообщение #%s удалено, ищу замену", message.id)
+            chart_uploads.pop(message.id, None)
+            config.set_runtime(server_id, "message_id", None)
+            message = await find_bot_message(channel, priority, deadline)
+            if message:
+                config.set_runtime(server_id, "message_id", message.id)
+                await discord_scheduler.submit(
+                    route,
+                    while_listed([server_id], lambda: message.edit(embed=embed, **chart_kwargs(message.id, charts))),
+                    priority, deadline
+                )
+                remember_charts(message.id, charts)
+                return message
+
+    message = await discord_scheduler.submit(
+        route, while_listed([server_id], lambda: channel.send(embed=embed, **chart_kwargs(None, charts))),
+        priority, deadline
+    )
+    remember_charts(message.id, charts)
+    config.set_runtime(server_id, "message_id", message.id)
+    update_log.info("Отправлено новое сообщение #%s", message.id)
+    return message
+
+async def delete_server_message(server_id: int):
+    """Удаляет отдельную плашку сервера (если она есть) и забывает её"""
+    server = config.servers[server_id]
+    message_id = server.get("message_id")
+    channel = client.get_channel(server["text_channel_id"]) if server.get("text_channel_id") else None
+
+    config.set_runtime(server_id, "message_id", None)
+    published_embeds.pop(server_id, None)
+    if message_id and channel is not None:
+        await delete_panel_message(channel, message_id)
+
+async def delete_panel_message(channel: discord.TextChannel, message_id: int):
+    """Удаляет сообщение плашки; ошибки только логируются"""
+    try:
+        await discord_scheduler.submit(
+            f"message:{channel.id}", channel.get_partial_message(message_id).delete, PRIORITY_INTERACTION
+        )
+    except Exception as e:
+        update_log.warning("Не удалось удалить плашку #%s: %s", message_id, e)
+
+async def update_text_embed(server_id: int, data: dict, priority: int = PRIORITY_PANEL):
     """Обновляет embed плашку только при изменении данных"""
     server = config.servers[server_id]
     channel_id = server.get("text_channel_id")
     if not channel_id:
         return None
 
+    # Сервер на общей плашке канала: обновляем её целиком
+    if server.get("shared_panel"):
+        last_snapshots[server_id] = data
+        await update_channel_panels(channel_id, priority)
+        return None
+
     channel = client.get_channel(channel_id)
     if not isinstance(channel, discord.TextChannel):
         return None
 
-    # Выбираем дизайн
-    design = server.get("design", "old")
-    if design == "new":
-        embed = create_new_embed(server_id, server, data)
-    else:
-        embed = create_old_embed(server_id, server, data)
+    # Фоновое обновление подчиняется правилам сервера; правки администратора применяются сразу
+    now = time.monotonic()
+    shown = panel_throttle.choose(server_id, server, data, now, force=priority != PRIORITY_PANEL)
+    if shown is not data:
+        update_log.debug("Изменение сервера #%s не проходит правила обновления, на плашке остаются прежние данные", server_id)
 
+    chart = await prepare_chart(channel_id, server_id, server, shown, fresh=shown is data)
+    charts = [chart] if chart else []
+    embed = create_server_embed(server_id, server, shown, chart)
+    fingerprint = embed_fingerprint(embed)
     message_id = server.get("message_id")
     message = None
 
-    if message_id:
-        try:
-            message = await channel.fetch_message(message_id)
-            # ✅ ВАЖНО: Проверяем, изменился ли контент, сравнивая с текущим embed
-            if (message and len(message.embeds) > 0 and 
-                message.embeds[0].description == embed.description and
-                message.embeds[0].title == embed.title and
-                message.embeds[0].color == embed.color):
-                # Контент не изменился, пропускаем обновление
-                print(f"[UPDATE] Данные для сервера #{server_id} не изменились, пропускаю обновление плашки")
-                return message
-        except discord.NotFound:
-            print(f"[UPDATE] Сообщение #{message_id} не найдено")
-            server["message_id"] = None
-            message = None
-        except Exception as e:
-            print(f"[UPDATE] Ошибка поиска сообщения #{message_id}: {e}")
-
-    if not message:
-        message = await find_bot_message(channel)
-        if message:
-            server["message_id"] = message.id
-            print(f"[UPDATE] Найдено существующее сообщение #{message.id}")
+    # Фоновые правки плашек, застрявшие в очереди, теряют смысл — следующий опрос принесёт свежие
+    deadline = time.monotonic() + DISCORD_PANEL_DEADLINE if priority == PRIORITY_PANEL else None
 
     try:
-        if message:
-            await message.edit(embed=embed)
-        else:
-            message = await channel.send(embed=embed)
-            server["message_id"] = message.id
-            print(f"[UPDATE] Отправлено новое сообщение #{message.id}")
-
-        config.save_config()
+        if message_id and server_id in published_embeds:
+            # ✅ ВАЖНО: Плашка совпадает с последней опубликованной — ни одного запроса к Discord
+            if published_embeds[server_id] == fingerprint:
+                panel_throttle.mark_shown(server_id, shown, now)
+                metrics.panel_edits_skipped.inc(panel="single", reason="unchanged" if shown is data else "rules")
+                update_log.debug("Данные для сервера #%s не изменились, пропускаю обновление плашки", server_id)
+                return channel.get_partial_message(message_id)
+            # Сообщение известно, редактируем без fetch_message
+            message = channel.get_partial_message(message_id)
+        elif message_id:
+            # Промах кэша (например, после перезапуска): сверяем с тем, что уже опубликовано
+            try:
+                message = await discord_scheduler.submit(
+                    f"message:{channel_id}", lambda: channel.fetch_message(message_id), priority, deadline
+                )
+                if message.embeds and embed_fingerprint(message.embeds[0]) == fingerprint:
+                    published_embeds[server_id] = fingerprint
+                    panel_throttle.mark_shown(server_id, shown, now)
+                    metrics.panel_edits_skipped.inc(panel="single", reason="unchanged" if shown is data else "rules")
+                    update_log.debug("Данные для сервера #%s не изменились, пропускаю обновление плашки", server_id)
+                    return message
+            except discord.NotFound:
+                update_log.info("Сообщение #%s не найдено", message_id)
+                config.set_runtime(server_id, "message_id", None)
+                message = None
+            except DiscordRequestExpired:
+                raise
+            except Exception as e:
+                update_log.warning("Ошибка поиска сообщения #%s: %s", message_id, e)
+
+        if not message:
+            message = await find_bot_message(channel, priority, deadline)
+            if message:
+                config.set_runtime(server_id, "message_id", message.id)
+                update_log.info("Найдено существующее сообщение #%s", message.id)
+
+        message = await send_or_edit_embed(channel, server_id, message, embed, priority, deadline, charts)
+        published_embeds[server_id] = fingerprint
+        panel_throttle.mark_edited(server_id, shown, now)
+        metrics.panel_edits.inc(panel="single")
         return message
 
-    except discord.HTTPException as e:
-        # ✅ ВАЖНО: Обрабатываем ошибку rate limit (429) для текстовых сообщений
-        if e.status == 429:
-            retry_after = e.response.headers.get('Retry-After', 5)
-            print(f"[UPDATE] Discord rate limit при обновлении плашки! Жду {retry_after} секунд...")
-            await asyncio.sleep(float(retry_after))
-            # Пробуем снова после ожидания
-            try:
-                if message:
-                    await message.edit(embed=embed)
-                else:
-                    message = await channel.send(embed=embed)
-                    server["message_id"] = message.id
-                print(f"[UPDATE] Повторное обновление плашки после ожидания")
-                config.save_config()
-                return message
-            except Exception as e2:
-                print(f"[UPDATE] Ошибка повторного обновления плашки: {e2}")
-        else:
-            print(f"[ERROR] Не удалось обновить плашку #{server_id}: {e}")
+    except DiscordRequestDropped:
+        update_log.info("Сервер #%s удалён, обновление его плашки отброшено", server_id)
+        return None
+    except DiscordRequestExpired:
+        update_log.info("Обновление плашки #%s устарело в очереди, пропускаю", server_id)
         return None
     except Exception as e:
-        print(f"[ERROR] Не удалось обновить плашку #{server_id}: {e}")
+        # После неудачной правки содержимое сообщения неизвестно — в следующий раз сверяемся заново
+        published_embeds.pop(server_id, None)
+        panel_throttle.forget(server_id)
+        update_log.error("Не удалось обновить плашку #%s: %s", server_id, e)
         return None
 
-async def update_voice_channel_name(server_id: int, data: dict):
-    """Обновляет название голосового канала только при изменении данных"""
-    server = config.servers[server_id]
-    
-    # Проверяем включена ли опция
-    if not server.get("update_name", True):
+# ==================== ОБЩИЕ ПЛАШКИ ====================
+def known_panel_messages(channel_id: int) -> set:
+    """id сообщений канала, уже закреплённых за плашками серверов или общими плашками"""
+    message_ids = {
+        server.get("message_id") for server in config.servers.values()
+        if server.get("text_channel_id") == channel_id
+    }
+    for scope in state_store.scopes(f"panel:{channel_id}:"):
+        message_ids.add(state_store.get(scope, "message_id"))
+    message_ids.discard(None)
+    return message_ids
+
+def panel_groups(channel_id: int) -> list:
+    """Серверы общей плашки канала, разбитые на сообщения по PANEL_MAX_EMBEDS"""
+    server_ids = sorted(
+        server_id for server_id, server in config.servers.items()
+        if server.get("shared_panel") and server.get("text_channel_id") == channel_id
+    )
+    return [server_ids[i:i + PANEL_MAX_EMBEDS] for i in range(0, len(server_ids), PANEL_MAX_EMBEDS)]
+
+def panel_fingerprint(embeds: list) -> str:
+    """Хэш общей плашки: отпечатки всех её embed по порядку"""
+    raw = "|".join(embed_fingerprint(embed) for embed in embeds)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def panel_snapshot(server_id: int) -> dict:
+    """Последний снимок сервера; до первого опроса — онлайн из сохранённого состояния"""
+    data = last_snapshots.get(server_id)
+    if data is None:
+        server = config.servers[server_id]
+        online, max_players = server.get("last_online") or (0, 0)
+        data = {"online": online, "max": max_players, "name": server["name"], "map": ""}
+    return data
+
+async def update_panel_message(channel: discord.TextChannel, chunk: int, server_ids: list,
+                               priority: int, deadline: Optional[float]):
+    """Обновляет одно сообщение общей плашки, если хотя бы один embed в нём изменился"""
+    scope = f"panel:{channel.id}:{chunk}"
+    route = f"message:{channel.id}"
+    now = time.monotonic()
+    # Настройки берём до первого await: сервер могут удалить, пока рисуются графики
+    servers = {server_id: config.servers[server_id] for server_id in server_ids if server_id in config.servers}
+    server_ids = list(servers)
+    if not server_ids:
         return
+    # Снимок берём один раз: до первого опроса panel_snapshot каждый раз собирает новый dict
+    snapshots = {server_id: panel_snapshot(server_id) for server_id in server_ids}
+    shown = {
+        server_id: panel_throttle.choose(
+            server_id, server, snapshots[server_id], now, force=priority != PRIORITY_PANEL
+        )
+        for server_id, server in servers.items()
+    }
+    # Графики всех серверов сообщения рисуются одной пачкой
+    chart_list = await asyncio.gather(*(
+        prepare_chart(channel.id, server_id, server, shown[server_id],
+                      fresh=shown[server_id] is snapshots[server_id])
+        for server_id, server in servers.items()
+    ))
+    charts = [chart for chart in chart_list if chart]
+    embeds = [
+        create_server_embed(server_id, servers[server_id], shown[server_id], chart)
+        for server_id, chart in zip(server_ids, chart_list)
+    ]
+    fingerprint = panel_fingerprint(embeds)
+    message_id = state_store.get(scope, "message_id")
+    message = None
 
-    channel_id = server.get("voice_channel_id")
-    if not channel_id:
-        return
+    if message_id and scope in published_panels:
+        if published_panels[scope] == fingerprint:
+            for server_id, data in shown.items():
+                panel_throttle.mark_shown(server_id, data, now)
+            metrics.panel_edits_skipped.inc(panel="shared", reason="unchanged")
+            panel_log.debug("Общая плашка %s не изменилась, пропускаю обновление", scope)
+            return
+        message = channel.get_partial_message(message_id)
+    elif message_id:
+        # Промах кэша: сверяем с тем, что уже опубликовано
+        try:
+            message = await discord_scheduler.submit(
+                route, lambda: channel.fetch_message(message_id), priority, deadline
+            )
+            if panel_fingerprint(message.embeds) == fingerprint:
+                published_panels[scope] = fingerprint
+                for server_id, data in shown.items():
+                    panel_throttle.mark_shown(server_id, data, now)
+                metrics.panel_edits_skipped.inc(panel="shared", reason="unchanged")
+                return
+        except discord.NotFound:
+            message = None
+
+    if message:
+        try:
+            await discord_scheduler.submit(
+                route,
+                while_listed(server_ids, lambda: message.edit(embeds=embeds, **chart_kwargs(message.id, charts))),
+                priority, deadline
+            )
+        except discord.NotFound:
+            panel_log.info("Сообщение общей плашки %s удалено, отправляю новое", scope)
+            chart_uploads.pop(message.id, None)
+            message = None
 
+    if not message:
+        message = await discord_scheduler.submit(
+            route, while_listed(server_ids, lambda: channel.send(embeds=embeds, **chart_kwargs(None, charts))),
+            priority, deadline
+        )
+        state_store.set(scope, "message_id", message.id)
+        panel_log.info("Отправлена общая плашка %s #%s", scope, message.id)
+
+    remember_charts(message.id, charts)
+    published_panels[scope] = fingerprint
+    metrics.panel_edits.inc(panel="shared")
+    for server_id, data in shown.items():
+        panel_throttle.mark_edited(server_id, data, now)
+
+async def update_channel_panels(channel_id: int, priority: int = PRIORITY_PANEL):
+    """Обновляет общие плашки канала: до PANEL_MAX_EMBEDS серверов в одном сообщении"""
     channel = client.get_channel(channel_id)
-    if not isinstance(channel, discord.VoiceChannel):
-        print(f"[VOICE] Канал #{channel_id} не является голосовым для сервера #{server_id}")
+    if not isinstance(channel, discord.TextChannel):
         return
 
+    groups = panel_groups(channel_id)
+    deadline = time.monotonic() + DISCORD_PANEL_DEADLINE if priority == PRIORITY_PANEL else None
+
+    for chunk, server_ids in enumerate(groups):
+        scope = f"panel:{channel_id}:{chunk}"
+        try:
+            await update_panel_message(channel, chunk, server_ids, priority, deadline)
+        except DiscordRequestDropped:
+            panel_log.info("Сервер общей плашки %s удалён, её обновление отброшено", scope)
+        except DiscordRequestExpired:
+            panel_log.info("Обновление общей плашки %s устарело в очереди, пропускаю", scope)
+        except Exception as e:
+            # После неудачной правки содержимое сообщения неизвестно — в следующий раз сверяемся заново
+            published_panels.pop(scope, None)
+            for server_id in server_ids:
+                panel_throttle.forget(server_id)
+            panel_log.error("Не удалось обновить общую плашку %s: %s", scope, e)
+
+    # Серверов стало меньше — лишние сообщения общей плашки удаляем
+    for scope in state_store.scopes(f"panel:{channel_id}:"):
+        if int(scope.rsplit(":", 1)[1]) < len(groups):
+            continue
+        message_id = state_store.get(scope, "message_id")
+        state_store.delete(scope)
+        published_panels.pop(scope, None)
+        if message_id:
+            try:
+                await discord_scheduler.submit(
+                    f"message:{channel_id}", channel.get_partial_message(message_id).delete, priority
+                )
+            except Exception as e:
+                panel_log.warning("Не удалось удалить лишнюю общую плашку #%s: %s", message_id, e)
+
+async def recreate_channel_panels(channel_id: int):
+    """Удаляет сообщения общих плашек канала и отправляет их заново"""
+    channel = client.get_channel(channel_id)
+    for scope in state_store.scopes(f"panel:{channel_id}:"):
+        message_id = state_store.get(scope, "message_id")
+        state_store.delete(scope)
+        published_panels.pop(scope, None)
+        if message_id and channel is not None:
+            try:
+                await discord_scheduler.submit(
+                    f"message:{channel_id}", channel.get_partial_message(message_id).delete, PRIORITY_INTERACTION
+                )
+            except Exception as e:
+                panel_log.warning("Ошибка удаления общей плашки #%s: %s", message_id, e)
+
+    await update_channel_panels(channel_id, PRIORITY_INTERACTION)
+
+class VoiceRenameBudget:
+    """Бюджет переименований одного голосового канала и последнее желаемое имя"""
+
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.history = deque()     # time.monotonic() последних переименований
+        self.blocked_until = 0.0   # до этого момента Discord вернул 429
+        self.pending = None        # (имя, состояние) — ждёт свободного слота
+        self.shown = None          # состояние (online, max, offline), показанное в имени
+        self.busy = False
+        self.timer = None
+
+    def next_slot(self, now: float) -> float:
+        """Когда можно переименовать канал, не превышая лимит Discord"""
+        while self.history and now - self.history[0] >= VOICE_RENAME_WINDOW:
+            self.history.popleft()
+        slot = now if len(self.history) < VOICE_RENAME_LIMIT else self.history[0] + VOICE_RENAME_WINDOW
+        return max(slot, self.blocked_until)
+
+class VoiceRenamer:
+    """Переименовывает голосовые каналы в фоне: в очереди только последнее имя, слоты по лимиту"""
+
+    def __init__(self):
+        self.budgets = {}  # channel_id -> VoiceRenameBudget
+        self.tasks = set()
+
+    def budget(self, channel_id: int) -> VoiceRenameBudget:
+        budget = self.budgets.get(channel_id)
+        if budget is None:
+            budget = self.budgets[channel_id] = VoiceRenameBudget(channel_id)
+        return budget
+
+    def request(self, channel_id: int, name: str, state: tuple):
+        """Запоминает желаемое имя; оно будет применено, когда откроется слот"""
+        budget = self.budget(channel_id)
+        budget.pending = (name, state)
+        if not budget.busy and budget.timer is None:
+            self._arm(budget)
+
+    def cancel(self, channel_id: int):
+        """Отменяет ожидающее переименование (имя в канале уже подходящее)"""
+        budget = self.budgets.get(channel_id)
+        if budget is not None:
+            budget.pending = None
+
+    def _arm(self, budget: VoiceRenameBudget):
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, budget.next_slot(time.monotonic()) - time.monotonic())
+        budget.timer = loop.call_later(delay, self._fire, budget)
+
+    def _fire(self, budget: VoiceRenameBudget):
+        budget.timer = None
+        task = asyncio.get_running_loop().create_task(self._rename(budget))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _rename(self, budget: VoiceRenameBudget):
+        if budget.pending is None:
+            return
+
+        channel = client.get_channel(budget.channel_id)
+        if not isinstance(channel, discord.VoiceChannel):
+            budget.pending = None
+            return
+
+        name, state = budget.pending
+        budget.pending = None
+        if channel.name == name:
+            budget.shown = state
+            return
+
+        budget.busy = True
+        try:
+            # Без повторов в очереди: повтор применил бы уже устаревшее имя, а _postpone
+            # после Retry-After возьмёт самое свежее из budget.pending
+            await discord_scheduler.submit(
+                f"channel:{budget.channel_id}", lambda: channel.edit(name=name), PRIORITY_RENAME, max_retries=0
+            )
+            budget.history.append(time.monotonic())
+            budget.shown = state
+            voice_log.info("Обновлено имя канала #%s: %s", budget.channel_id, name)
+        except discord.Forbidden:
+            voice_log.error("Нет прав для изменения канала #%s", budget.channel_id)
+        except discord.RateLimited as e:
+            # Долгий Retry-After (обычное дело для переименований): discord.py не ждёт, а поднимает ошибку
+            self._postpone(budget, name, state, e.retry_after)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                self._postpone(budget, name, state, float(e.response.headers.get('Retry-After', 5)))
+            else:
+                voice_log.error("Ошибка обновления канала #%s: %s", budget.channel_id, e)
+        finally:
+            budget.busy = False
+
+        if budget.pending is not None and budget.timer is None:
+            self._arm(budget)
+
+    def _postpone(self, budget: VoiceRenameBudget, name: str, state: tuple, retry_after: float):
+        # Переносим переименование на момент окончания лимита; имя, пришедшее за это время, главнее
+        budget.blocked_until = time.monotonic() + retry_after
+        if budget.pending is None:
+            budget.pending = (name, state)
+        voice_log.warning("Discord rate limit для канала #%s, перенос на %.0fс", budget.channel_id, retry_after)
+
+voice_renamer = VoiceRenamer()
+
+def same_voice_bucket(shown: tuple, state: tuple, bucket: int) -> bool:
+    """Проверяет, попадает ли новый онлайн в тот же шаг отображения, что уже показан"""
+    shown_online, shown_max, shown_offline = shown
+    online, max_players, offline = state
+    return (
+        shown_offline == offline
+        and shown_max == max_players
+        and (shown_online > 0) == (online > 0)
+        and shown_online // bucket == online // bucket
+    )
+
+def voice_channel_name(server: dict, data: dict) -> str:
+    """Название голосового канала для снимка сервера (макс 32 символа в Discord)"""
     # Выбираем эмодзи в зависимости от онлайна
     if data["online"] > 0:
         emoji = "🟢"
     else:
         emoji = "🔴"
     
-    # Формируем новое имя (макс 32 символа в Discord)
     server_name = server['name'][:15] if len(server['name']) > 15 else server['name']
-    new_name = f"{emoji} {data['online']}/{data['max']} | {server_name}"
-    new_name = new_name[:32]
+    if data.get("offline"):
+        new_name = f"⚫ Офлайн | {server_name}"
+    else:
+        new_name = f"{emoji} {data['online']}/{data['max']} | {server_name}"
+    return new_name[:32]
+
+def update_voice_channel_name(server_id: int, data: dict) -> Optional[str]:
+    """Планирует новое название голосового канала; сам вызов никогда не ждёт Discord"""
+    server = config.servers[server_id]
+    
+    # Проверяем включена ли опция
+    if not server.get("update_name", True):
+        return None
+
+    channel_id = server.get("voice_channel_id")
+    if not channel_id:
+        return None
+
+    channel = client.get_channel(channel_id)
+    if not isinstance(channel, discord.VoiceChannel):
+        voice_log.warning("Канал #%s не является голосовым для сервера #%s", channel_id, server_id)
+        return None
+
+    new_name = voice_channel_name(server, data)
+    state = (data["online"], data["max"], bool(data.get("offline")))
     
     # ✅ ВАЖНО: Проверяем, изменилось ли имя, чтобы не отправлять лишний запрос в Discord
+    budget = voice_renamer.budget(channel_id)
     if channel.name == new_name:
-        return  # Имя не изменилось, выходим
-    
-    try:
-        await channel.edit(name=new_name)
-        print(f"[VOICE] Обновлено имя канала для сервера #{server_id}: {new_name}")
-    except discord.Forbidden:
-        print(f"[VOICE] Нет прав для изменения канала #{channel_id}")
-    except discord.HTTPException as e:
-        # ✅ ВАЖНО: Обрабатываем ошибку rate limit (429)
-        if e.status == 429:
-            retry_after = e.response.headers.get('Retry-After', 5)
-            print(f"[VOICE] Discord rate limit! Жду {retry_after} секунд...")
-            await asyncio.sleep(float(retry_after))
-            # Пробуем снова после ожидания
-            try:
-                await channel.edit(name=new_name)
-                print(f"[VOICE] Повторное обновление имени канала после ожидания")
-            except Exception as e2:
-                print(f"[VOICE] Ошибка повторного обновления: {e2}")
+        budget.shown = state
+        voice_renamer.cancel(channel_id)
+        return new_name
+
+    # Изменение в пределах того же шага не стоит одного из двух переименований за 10 минут
+    bucket = max(1, int(server.get("voice_bucket") or 1))
+    if budget.shown is not None and same_voice_bucket(budget.shown, state, bucket):
+        voice_renamer.cancel(channel_id)
+        return channel.name
+
+    voice_renamer.request(channel_id, new_name, state)
+    return new_name
+
+def enqueue_snapshot(server_id: int, data: dict, panels: Optional[set] = None):
+    """Ставит снимок сервера в очередь публикации.
+
+    Общая плашка канала публикуется одним ключом ("panel", канал); если передан panels,
+    ключ только собирается туда, чтобы цикл опубликовал плашку один раз после всех опросов.
+    """
+    server = config.servers[server_id]
+    last_snapshots[server_id] = data
+
+    shared = server.get("shared_panel") and server.get("text_channel_id")
+    if shared:
+        panel_key = ("panel", server["text_channel_id"])
+        if panels is None:
+            publish_queue.put(panel_key, None)
         else:
-            print(f"[VOICE] Ошибка обновления канала #{server_id}: {e}")
-async def update_server_status(server_id: int):
-    """Обновляет статус конкретного сервера"""
+            panels.add(panel_key)
+
+    if server.get("voice_channel_id") or (server.get("text_channel_id") and not shared):
+        publish_queue.put(server_id, data)
+
+async def update_server_status(server_id: int, panels: Optional[set] = None) -> Optional[dict]:
+    """Опрашивает сервер и ставит свежий снимок в очередь публикации"""
     if server_id not in config.servers:
-        return
+        return None
 
     server = config.servers[server_id]
-    data = await get_server_info(server["ip"], server["port"])
+    breaker = get_breaker(server_id)
+    # Запоминаем до allow(): после паузы он переводит открытый breaker в half-open
+    was_closed = breaker.state == CircuitBreaker.CLOSED
+
+    # Пока breaker открыт, недоступный сервер не опрашивается вовсе
+    if not breaker.allow(time.monotonic()):
+        return None
+
+    # Плановый опрос всегда доходит до сервера: ошибка из кэша не должна считаться новой ошибкой breaker
+    async with a2s_semaphore:
+        data = await get_server_info(server["ip"], server["port"], use_negative=False)
+
+    if server_id not in config.servers:
+        return None
 
     if not data:
+        breaker.record_failure(time.monotonic())
+        stats_store.record(server_id, None)
+        # Неудачная проба half-open снова открывает breaker — это не новое падение сервера
+        if breaker.state == CircuitBreaker.OPEN and was_closed:
+            breaker_log.warning("Сервер #%s недоступен, следующая проверка через %.0fс",
+                                server_id, breaker.retry_at - time.monotonic())
+            enqueue_snapshot(server_id, {
+                "online": 0,
+                "max": server["last_online"][1],
+                "offline": True,
+                "since": breaker.offline_since
+            }, panels)
+        return None
+
+    if breaker.state != CircuitBreaker.CLOSED:
+        breaker_log.info("Сервер #%s снова отвечает", server_id)
+    breaker.record_success()
+
+    config.set_runtime(server_id, "last_online", (data["online"], data["max"]))
+    record_history(server_id, data)
+    stats_store.record(server_id, data)
+    enqueue_snapshot(server_id, data, panels)
+
+    return data
+
+async def publish_server_status(server_id: int, data: dict):
+    """Публикует снимок сервера в Discord: плашка и название голосового канала"""
+    if server_id not in config.servers:
         return
 
-    server["last_online"] = (data["online"], data["max"])
+    server = config.servers[server_id]
 
-    if server.get("text_channel_id"):
+    # Общую плашку публикует отдельный ключ очереди
+    if server.get("text_channel_id") and not server.get("shared_panel"):
         await update_text_embed(server_id, data)
 
     if server.get("voice_channel_id"):
-        await update_voice_channel_name(server_id, data)
+        update_voice_channel_name(server_id, data)
 
-    config.save_config()
+# ==================== КОНВЕЙЕР ПУБЛИКАЦИИ ====================
+class SnapshotQueue:
+    """Очередь публикации, которая хранит только последний снимок для каждого ключа.
+
+    Ключ — server_id или ("panel", id канала) для общей плашки.
+    """
+
+    def __init__(self):
+        self._latest = {}              # ключ -> последний снимок
+        self._active = set()           # ключи, которые сейчас публикуются
+        self._order = asyncio.Queue()  # порядок публикации
+
+    def put(self, key, data: Optional[dict]):
+        """Кладёт снимок; более старый неопубликованный снимок с тем же ключом заменяется"""
+        if key not in self._latest and key not in self._active:
+            self._order.put_nowait(key)
+        self._latest[key] = data
+
+    async def get(self) -> tuple:
+        """Ждёт следующий ключ и забирает его последний снимок"""
+        while True:
+            key = await self._order.get()
+            if key in self._latest:
+                self._active.add(key)
+                return key, self._latest.pop(key)
+
+    def done(self, key):
+        """Отмечает окончание публикации; пришедший за это время снимок снова встаёт в очередь"""
+        self._active.discard(key)
+        if key in self._latest:
+            self._order.put_nowait(key)
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+publish_queue = SnapshotQueue()
+publish_workers = []
+
+async def publish_worker():
+    """Забирает снимки из очереди и публикует их, не задерживая опрос серверов"""
+    while True:
+        key, data = await publish_queue.get()
+        try:
+            if isinstance(key, tuple):
+                await update_channel_panels(key[1])
+            else:
+                await publish_server_status(key, data)
+        except Exception as e:
+            publish_log.error("Ошибка публикации %s: %s", key, e)
+        finally:
+            publish_queue.done(key)
+
+def start_publish_workers():
+    """Запускает обработчики очереди публикации (один раз за жизнь процесса)"""
+    if publish_workers:
+        return
+    for _ in range(DISCORD_CONCURRENCY):
+        publish_workers.append(asyncio.get_running_loop().create_task(publish_worker()))
+
+# ==================== ОБРАБОТКА НЕДОСТУПНЫХ СЕРВЕРОВ ====================
+class CircuitBreaker:
+    """Учёт ошибок сервера: экспоненциальная пауза с джиттером и состояния closed/open/half-open"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retry_at = 0.0        # time.monotonic(), раньше которого сервер не опрашивается
+        self.offline_since = None  # time.time() первой ошибки в текущей серии
+
+    def allow(self, now: float) -> bool:
+        """Можно ли опрашивать сервер; после паузы открытый breaker пропускает одну пробу"""
+        if self.state == self.OPEN:
+            if now < self.retry_at:
+                return False
+            self.state = self.HALF_OPEN
+        return True
+
+    def backoff(self) -> float:
+        """Пауза до следующей попытки: экспонента от числа ошибок с джиттером"""
+        delay = min(BREAKER_MAX_BACKOFF, BREAKER_BASE_BACKOFF * 2 ** (self.failures - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def record_failure(self, now: float):
+        self.failures += 1
+        if self.offline_since is None:
+            self.offline_since = time.time()
+        self.retry_at = now + self.backoff()
+        if self.state == self.HALF_OPEN or self.failures >= BREAKER_FAILURE_THRESHOLD:
+            self.state = self.OPEN
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retry_at = 0.0
+        self.offline_since = None
+
+# Состояние доступности серверов: server_id -> CircuitBreaker
+breakers = {}
+
+def get_breaker(server_id: int) -> CircuitBreaker:
+    breaker = breakers.get(server_id)
+    if breaker is None:
+        breaker = breakers[server_id] = CircuitBreaker()
+    return breaker
+
+# ==================== ПЛАНИРОВЩИК ОПРОСА ====================
+class PollScheduler:
+    """Очередь опроса на куче: у каждого сервера свой срок следующего опроса.
+
+    Интервал подстраивается под то, насколько менялся онлайн в последних опросах:
+    пустые и стабильные серверы опрашиваются реже, активные — чаще. Сроки привязаны
+    к постоянной фазе сервера внутри интервала, поэтому опросы и правки идут
+    равномерно, а не пачкой в начале каждой минуты. Серверы одной общей плашки
+    опрашиваются вместе: фаза у них от канала, интервал — наименьший среди них.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, default_interval: float):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self._heap = []       # (срок, server_id); устаревшие записи пропускаются при извлечении
+        self._due = {}        # server_id -> актуальный срок
+        self._running = set() # серверы, которые сейчас опрашиваются
+        self._samples = {}    # server_id -> последние значения онлайна
+        self.lag = 0.0        # наибольшее опоздание опроса при последнем pop_due
+
+    def schedule(self, server_id: int, due: float):
+        """Назначает срок следующего опроса сервера"""
+        self._due[server_id] = due
+        heapq.heappush(self._heap, (due, server_id))
+
+    @staticmethod
+    def panel_members(server_id: int) -> list:
+        """Серверы, публикуемые одним сообщением с этим сервером (сам сервер, если он не на общей плашке)"""
+        server = config.servers.get(server_id)
+        if not server or not server.get("shared_panel") or not server.get("text_channel_id"):
+            return [server_id]
+        return [
+            other_id for other_id, other in config.servers.items()
+            if other.get("shared_panel") and other.get("text_channel_id") == server["text_channel_id"]
+        ]
+
+    @staticmethod
+    def phase(server_id: int) -> float:
+        """Постоянная фаза сервера внутри интервала опроса (доля от 0 до 1).
+
+        Мультипликативный хэш Фибоначчи: идущие подряд id расходятся по интервалу равномерно.
+        У серверов общей плашки фаза общая — от id канала, чтобы их опросы и правка совпадали.
+        """
+        server = config.servers.get(server_id)
+        key = server_id
+        if server and server.get("shared_panel") and server.get("text_channel_id"):
+            key = server["text_channel_id"]
+        return (key * 2654435769) % 2 ** 32 / 2 ** 32
+
+    def aligned(self, server_id: int, earliest: float, interval: float) -> float:
+        """Ближайший срок не раньше earliest, приходящийся на фазу сервера"""
+        offset = self.phase(server_id) * interval
+        return math.ceil((earliest - offset) / interval) * interval + offset
+
+    def sync(self, server_ids, now: float):
+        """Добавляет новые серверы (каждый в своей фазе первого интервала) и забывает удалённые"""
+        server_ids = set(server_ids)
+        for server_id in server_ids:
+            if server_id not in self._due and server_id not in self._running:
+                self.schedule(server_id, self.aligned(server_id, now, self.default_interval))
+        for server_id in list(self._due):
+            if server_id not in server_ids:
+                del self._due[server_id]
+                self._samples.pop(server_id, None)
+
+    def pop_due(self, now: float) -> list:
+        """Забирает все серверы, срок опроса которых наступил"""
+        due_ids = []
+        self.lag = 0.0
+        while self._heap and self._heap[0][0] <= now:
+            due, server_id = heapq.heappop(self._heap)
+            if self._due.get(server_id) != due:
+                continue  # запись устарела: сервер удалён или перепланирован
+            del self._due[server_id]
+            self.lag = max(self.lag, now - due)
+            self._running.add(server_id)
+            due_ids.append(server_id)
+        return due_ids
+
+    def record(self, server_id: int, online: int):
+        """Запоминает онлайн из очередного опроса"""
+        samples = self._samples.get(server_id)
+        if samples is None:
+            samples = self._samples[server_id] = deque(maxlen=POLL_HISTORY_SIZE)
+        samples.append(online)
+
+    def interval(self, server_id: int) -> float:
+        """Интервал опроса; у общей плашки — наименьший среди её серверов"""
+        return min(self._own_interval(member_id) for member_id in self.panel_members(server_id))
+
+    def _own_interval(self, server_id: int) -> float:
+        """Интервал опроса: максимальный для стабильного онлайна, меньше при колебаниях"""
+        samples = self._samples.get(server_id)
+        if not samples or len(samples) < 2:
+            return self.default_interval
+
+        mean = sum(samples) / len(samples)
+        deviation = (sum((x - mean) ** 2 for x in samples) / len(samples)) ** 0.5
+        return max(self.min_interval, min(self.max_interval, self.max_interval / (1 + deviation)))
+
+    def reschedule(self, server_id: int, now: float, due: Optional[float] = None):
+        """Возвращает опрошенный сервер в очередь: к указанному сроку или в его фазу следующего интервала"""
+        self._running.discard(server_id)
+        if server_id not in config.servers:
+            return
+        if due is None:
+            interval = self.interval(server_id)
+            # Не раньше чем через полинтервала: при смене интервала сервер переходит на новую сетку.
+            # И не раньше CACHE_TTL — иначе опрос получит ответ из кэша и запишет его как новый замер
+            due = self.aligned(server_id, now + max(interval / 2, CACHE_TTL), interval)
+        self.schedule(server_id, due)
+
+poll_scheduler = PollScheduler(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_DEFAULT_INTERVAL)
+
+# ==================== ИСТОРИЯ ОНЛАЙНА ====================
+class HistoryTier:
+    """Кольцевой буфер агрегатов онлайна с фиксированным шагом.
+
+    Ячейка хранит номер интервала, минимум, пик, сумму и число замеров; новый интервал
+    просто перезаписывает ячейку, в которую попадает, поэтому память не растёт.
+    """
+
+    def __init__(self, step: int, size: int):
+        self.step = step
+        self.size = size
+        self.bucket = array("i", [-1]) * size  # номер интервала: time // step
+        self.low = array("H", [0]) * size
+        self.peak = array("H", [0]) * size
+        self.total = array("I", [0]) * size
+        self.count = array("H", [0]) * size
+        self.slots = array("H", [0]) * size
+
+    @property
+    def span(self) -> int:
+        return self.step * self.size
+
+    def add(self, timestamp: float, online: int, max_players: int):
+        bucket = int(timestamp) // self.step
+        i = bucket % self.size
+        if self.bucket[i] != bucket:
+            self.bucket[i] = bucket
+            self.low[i] = self.peak[i] = online
+            self.total[i] = online
+            self.count[i] = 1
+            self.slots[i] = max_players
+            return
+        self.low[i] = min(self.low[i], online)
+        self.peak[i] = max(self.peak[i], online)
+        self.total[i] += online
+        self.count[i] = min(self.count[i] + 1, 0xFFFF)
+        self.slots[i] = max(self.slots[i], max_players)
+
+    def summary(self, since: float, until: float) -> Optional[dict]:
+        """min/avg/peak за [since, until]; просматривает не больше size ячеек"""
+        first = int(since) // self.step
+        last = int(until) // self.step
+        first = max(first, last - self.size + 1)
+
+        low = peak = slots = None
+        total = count = 0
+        oldest = None
+        for bucket in range(first, last + 1):
+            i = bucket % self.size
+            if self.bucket[i] != bucket:
+                continue
+            if oldest is None:
+                oldest = bucket * self.step
+            low = self.low[i] if low is None else min(low, self.low[i])
+            peak = self.peak[i] if peak is None else max(peak, self.peak[i])
+            slots = self.slots[i] if slots is None else max(slots, self.slots[i])
+            total += self.total[i]
+            count += self.count[i]
+
+        if not count:
+            return None
+        return {"min": low, "avg": total / count, "peak": peak, "max": slots, "samples": count, "since": oldest}
+
+    def series(self, since: float, until: float, points: int) -> list:
+        """Средний онлайн на points равных отрезках [since, until); отрезок без замеров — None"""
+        totals = [0] * points
+        counts = [0] * points
+        width = (until - since) / points
+        last = int(until) // self.step
+        first = max(int(since) // self.step, last - self.size + 1)
+        for bucket in range(first, last + 1):
+            i = bucket % self.size
+            if self.bucket[i] != bucket:
+                continue
+            point = int((bucket * self.step - since) // width)
+            if 0 <= point < points:
+                totals[point] += self.total[i]
+                counts[point] += self.count[i]
+        return [total / count if count else None for total, count in zip(totals, counts)]
+
+class ServerHistory:
+    """История онлайна одного сервера: каждый замер сразу сворачивается во все уровни"""
+
+    def __init__(self):
+        self.tiers = [HistoryTier(step, size) for step, size in HISTORY_TIERS]
+
+    def add(self, timestamp: float, online: int, max_players: int):
+        for tier in self.tiers:
+            tier.add(timestamp, online, max_players)
+
+    def summary(self, window: int, now: Optional[float] = None) -> Optional[dict]:
+        """Статистика за последние window секунд по самому подробному уровню, который их покрывает"""
+        now = time.time() if now is None else now
+        tier = next((tier for tier in self.tiers if tier.span >= window), self.tiers[-1])
+        return tier.summary(now - window, now)
+
+    def series(self, window: int, points: int, now: Optional[float] = None) -> list:
+        """Онлайн за последние window секунд по points отрезкам, выровненным по времени"""
+        now = time.time() if now is None else now
+        tier = next((tier for tier in self.tiers if tier.span >= window), self.tiers[-1])
+        # Границы отрезков не сдвигаются с каждым опросом — иначе график менялся бы без причины
+        width = window / points
+        until = (now // width + 1) * width
+        return tier.series(until - window, until, points)
+
+# История онлайна серверов: server_id -> ServerHistory
+histories = {}
+
+def record_history(server_id: int, data: dict):
+    history = histories.get(server_id)
+    if history is None:
+        history = histories[server_id] = ServerHistory()
+    history.add(time.time(), data["online"], data["max"])
+
+# ==================== ГРАФИКИ ОНЛАЙНА ====================
+class ChartRenderer:
+    """Отрисовка графиков в пуле процессов с кэшем по содержимому.
+
+    Ключ кэша — хэш высот столбцов и стиля, так что одинаковый график не рисуется дважды.
+    Запросы одного канала, пришедшие в одной итерации цикла событий, рисуются одной пачкой.
+    """
+
+    def __init__(self, workers: int, cache_size: int):
+        self.workers = workers
+        self.cache_size = cache_size
+        self._cache = OrderedDict()   # ключ -> PNG
+        self._batches = {}            # канал -> {ключ: (задание, future)}
+        self._tasks = set()           # Отрисовки, которые ещё выполняются
+        self._pool = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn на любой ОС: fork копировал бы потоки логирования и соединения SQLite.
+            # Процесс пула импортирует главный модуль заново, поэтому хранилища и логирование
+            # открываются в initialize(), а не при импорте
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    async def render(self, batch_key, key: str, job: tuple) -> bytes:
+        png = self._cache.get(key)
+        if png is not None:
+            self._cache.move_to_end(key)
+            return png
+
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(batch_key)
+        if batch is None:
+            batch = self._batches[batch_key] = {}
+            # Остальные запросы этой итерации успеют попасть в ту же пачку
+            loop.call_soon(self._flush, batch_key)
+        if key not in batch:
+            batch[key] = (job, loop.create_future())
+        return await asyncio.shield(batch[key][1])
+
+    def _flush(self, batch_key):
+        batch = self._batches.pop(batch_key, None)
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: dict):
+        keys = list(batch)
+        try:
+            images = await asyncio.get_running_loop().run_in_executor(
+                self._get_pool(), render_sparklines, [batch[key][0] for key in keys]
+            )
+        except Exception as e:
+            chart_log.error("Ошибка отрисовки %d графиков: %s", len(keys), e)
+            for key in keys:
+                future = batch[key][1]
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        chart_log.debug("Нарисовано графиков: %d", len(keys))
+        for key, png in zip(keys, images):
+            self._cache[key] = png
+            future = batch[key][1]
+            if not future.done():
+                future.set_result(png)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+chart_renderer = ChartRenderer(CHART_WORKERS, CHART_CACHE_SIZE)
+
+# Последний график каждого сервера: server_id -> (имя файла, PNG)
+last_charts = {}
+# Какие графики сейчас приложены к сообщению: message_id -> имена файлов
+chart_uploads = {}
+
+def chart_heights(server_id: int, data: dict) -> Optional[tuple]:
+    """Высоты столбцов графика из истории онлайна (масштаб — число слотов сервера)"""
+    history = histories.get(server_id)
+    if history is None:
+        return None
+    series = history.series(CHART_WINDOW, CHART_POINTS)
+    known = [value for value in series if value is not None]
+    if len(known) < 2:
+        return None
+    scale = max(data["max"], max(known), 1)
+    return tuple(
+        None if value is None else min(CHART_HEIGHT - 1, round(value / scale * (CHART_HEIGHT - 1)))
+        for value in series
+    )
+
+async def prepare_chart(channel_id: int, server_id: int, server: dict, data: dict,
+                        fresh: bool = True) -> Optional[tuple]:
+    """График для плашки нового дизайна: (имя файла, PNG) или None.
+
+    Пока правила обновления держат на плашке прежние данные (fresh=False), держим и прежний график.
+    """
+    if not server.get("show_chart") or server.get("design", "old") != "new" or data.get("offline"):
+        return None
+    if not fresh:
+        return last_charts.get(server_id)
+
+    heights = chart_heights(server_id, data)
+    if heights is None:
+        return None
+
+    color = int(server.get("embed_color", "00FF00"), 16)
+    job = (heights, CHART_WIDTH, CHART_HEIGHT, color)
+    key = hashlib.sha1(repr(job).encode("utf-8")).hexdigest()
+    try:
+        png = await chart_renderer.render(channel_id, key, job)
+    except Exception:
+        return last_charts.get(server_id)
+
+    chart = (f"chart_{key[:16]}.png", png)
+    last_charts[server_id] = chart
+    return chart
+
+def chart_kwargs(message_id: Optional[int], charts: list) -> dict:
+    """Вложения для send/edit: при правке файлы загружаются, только если набор графиков изменился"""
+    if message_id is None:
+        if not charts:
+            return {}
+    elif chart_uploads.get(message_id) == tuple(name for name, _ in charts):
+        return {}
+
+    files = [discord.File(io.BytesIO(png), filename=name) for name, png in charts]
+    return {"files": files} if message_id is None else {"attachments": files}
+
+def remember_charts(message_id: int, charts: list):
+    chart_uploads[message_id] = tuple(name for name, _ in charts)
 
 # ==================== ФОНОВЫЕ ЗАДАЧИ ====================
-@tasks.loop(seconds=60)
+class CycleMonitor:
+    """Такт фонового цикла: насколько проход опоздал и сколько тактов пропущено.
+
+    Пропущенные такты не догоняются: следующий проход один раз забирает из планировщика
+    всё, что накопилось (у сервера в куче только один срок), а догоняющие вызовы сразу
+    после долгого прохода пропускаются.
+    """
+
+    def __init__(self, tick: float):
+        self.tick = tick
+        self.last_start = None
+        self.late = 0.0    # опоздание последнего прохода относительно такта (секунды)
+        self.missed = 0    # сколько тактов целиком пришлось на предыдущий проход
+
+    def begin(self, now: float) -> bool:
+        """Отмечает начало прохода; False — вызов пришёл раньше такта и его надо пропустить"""
+        if self.last_start is not None:
+            gap = now - self.last_start
+            if gap < self.tick / 2:
+                return False
+            self.late = max(0.0, gap - self.tick)
+            self.missed = max(0, int(gap // self.tick) - 1)
+        self.last_start = now
+        return True
+
+cycle_monitor = CycleMonitor(SCHEDULER_TICK)
+
+@tasks.loop(seconds=SCHEDULER_TICK)
 async def auto_update_servers():
-    """Автоматическое обновление всех серверов с защитой от rate limit"""
-    if not config.servers:
+    """Опрашивает серверы, срок опроса которых наступил, с защитой от rate limit"""
+    if not cycle_monitor.begin(time.monotonic()):
+        return
+    if cycle_monitor.missed:
+        metrics.cycle_missed_ticks.inc(cycle_monitor.missed)
+        task_log.warning("Цикл опоздал на %.1fс, пропущено тактов: %d — объединяю их в один проход",
+                         cycle_monitor.late, cycle_monitor.missed,
+                         extra={"late": round(cycle_monitor.late, 3), "missed": cycle_monitor.missed})
+
+    # Команды могут менять набор серверов во время опроса — проход работает со снимком
+    servers = config.view()
+    if not servers:
+        return
+
+    poll_scheduler.sync(servers.keys(), time.monotonic())
+    server_ids = poll_scheduler.pop_due(time.monotonic())
+    metrics.poll_lag.set(poll_scheduler.lag)
+    if not server_ids:
         return
     
-    print(f"[TASK] Начинаю обновление {len(config.servers)} серверов...")
+    task_log.info("Начинаю обновление %d из %d серверов", len(server_ids), len(servers))
     start_time = time.time()
     
     successful = 0
     failed = 0
     
-    for server_id in config.servers.keys():
-        try:
-            await update_server_status(server_id)
-            successful += 1
-        except Exception as e:
-            print(f"[TASK] Ошибка обновления сервера #{server_id}: {e}")
+    # Серверы опрашиваются одновременно, время цикла определяет самый медленный
+    panels = set()
+    results = await asyncio.gather(
+        *(update_server_status(server_id, panels) for server_id in server_ids),
+        return_exceptions=True
+    )
+
+    # Каждая затронутая общая плашка публикуется один раз за цикл
+    for panel_key in panels:
+        publish_queue.put(panel_key, None)
+
+    for server_id, result in zip(server_ids, results):
+        if isinstance(result, Exception):
+            task_log.error("Ошибка обновления сервера #%s: %s", server_id, result)
             failed += 1
-        
-        # ✅ ВАЖНО: Задержка 2 секунды между серверами для избежания лимита Discord
-        await asyncio.sleep(2)
+        elif result is None:
+            failed += 1
+        else:
+            poll_scheduler.record(server_id, result["online"])
+            successful += 1
+
+    # Планируем после всех замеров: серверы общей плашки должны получить одинаковый интервал
+    now = time.monotonic()
+    for server_id in server_ids:
+        # После ошибок следующий опрос определяет пауза breaker, а не обычный интервал
+        breaker = breakers.get(server_id)
+        due = breaker.retry_at if breaker and breaker.failures else None
+        poll_scheduler.reschedule(server_id, now, due)
     
+    # Все изменения за цикл записываются на диск одним разом
+    config.flush()
+    stats_store.flush()
+
     elapsed = time.time() - start_time
-    print(f"[TASK] Обновление завершено: {successful} успешно, {failed} с ошибками. Время: {elapsed:.2f}с")
+    metrics.cycle_duration.observe(elapsed)
+    if elapsed > SCHEDULER_TICK:
+        metrics.cycle_overruns.inc()
+        task_log.warning("Цикл длился %.1fс — дольше такта на %.1fс", elapsed, elapsed - SCHEDULER_TICK,
+                         extra={"overrun": round(elapsed - SCHEDULER_TICK, 3)})
+    metrics.servers.set(len(config.servers))
+    metrics.publish_queue.set(len(publish_queue))
+    task_log.info("Обновление завершено: %d успешно, %d с ошибками. Время: %.2fс", successful, failed, elapsed,
+             extra={"polled": len(server_ids), "successful": successful, "failed": failed, "elapsed": round(elapsed, 3)})
+
+# ==================== ОТВЕТЫ НА КОМАНДЫ ====================
+# Фоновые обновления ответов на команды (ссылки держим, чтобы задачи не собрал сборщик мусора)
+command_tasks = set()
+
+def spawn_command_task(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    command_tasks.add(task)
+    task.add_done_callback(command_tasks.discard)
+
+def as_of(timestamp: float) -> str:
+    """Подпись со временем снимка (Discord покажет его в часовом поясе читателя)"""
+    return f"🕒 Данные на <t:{int(timestamp)}:T> (<t:{int(timestamp)}:R>)"
+
+def with_status(response: dict, *lines: str) -> dict:
+    """Ответ (content/embed) с дописанными строками состояния; embed=None при правке убирает старый embed"""
+    content = "\n".join(line for line in (response.get("content"), *lines) if line)
+    return {"content": content or None, "embed": response.get("embed")}
+
+def without_empty(response: dict) -> dict:
+    return {key: value for key, value in response.items() if value is not None}
+
+async def respond_with_snapshot(interaction: discord.Interaction, server: dict, render, on_fresh=None):
+    """Отвечает на команду сразу по последнему снимку из кэша, а свежие данные подставляет правкой ответа.
+
+    render(data) возвращает аргументы ответа (content/embed); data=None — данных о сервере нет.
+    on_fresh(data) вызывается со свежими данными перед правкой ответа; с ним ответ правится всегда.
+    """
+    stale = cache.get_stale(server["ip"], server["port"])
+    if stale:
+        response = with_status(render(stale[0]), as_of(stale[1]))
+    else:
+        response = {"content": "⏳ Запрашиваю данные сервера…"}
+    await interaction.response.send_message(ephemeral=True, **without_empty(response))
+    spawn_command_task(refresh_snapshot_response(interaction, server, render, on_fresh, stale))
+
+async def refresh_snapshot_response(interaction: discord.Interaction, server: dict, render, on_fresh, stale):
+    """Запрашивает сервер и правит ответ на команду, если данные новее показанных"""
+    try:
+        data = await get_server_info(server["ip"], server["port"])
+        if data is None:
+            if stale is None:
+                response = with_status(render(None))
+            else:
+                response = with_status(render(stale[0]), as_of(stale[1]),
+                                       "⚠️ Сервер не ответил, показаны последние известные данные")
+        else:
+            if on_fresh is not None:
+                on_fresh(data)
+            if stale and data is stale[0] and on_fresh is None:
+                return  # в кэше уже лежал свежий снимок — ответ актуален
+            fresh = cache.get_stale(server["ip"], server["port"])
+            response = with_status(render(data), as_of(fresh[1] if fresh else time.time()))
+        await edit_response(interaction, **response)
+    except Exception as e:
+        commands_log.warning("Не удалось обновить ответ на команду: %s", e)
+
+async def respond_and_refresh_panel(interaction: discord.Interaction, server_id: int, prepare=None, **response):
+    """Сразу подтверждает команду настройки, а плашку обновляет в фоне и дописывает результат в ответ.
+
+    prepare — необязательная корутина-функция, которая выполняется в фоне перед обновлением плашки.
+    """
+    server = config.servers[server_id]
+    if not server.get("text_channel_id"):
+        await interaction.response.send_message(ephemeral=True, **without_empty(with_status(response)))
+        return
+    await interaction.response.send_message(
+        ephemeral=True, **without_empty(with_status(response, "⏳ Плашка обновляется…"))
+    )
+    spawn_command_task(refresh_panel_response(interaction, server_id, prepare, response))
+
+async def refresh_panel_response(interaction: discord.Interaction, server_id: int, prepare, response: dict):
+    """Обновляет плашку по последнему снимку (сервер опрашивается, только если снимка нет)"""
+    try:
+        if prepare is not None:
+            await prepare()
+        server = config.servers.get(server_id)
+        if server is None:
+            return
+        data = await get_server_info(server["ip"], server["port"], allow_stale=True)
+        if data is None:
+            status = "⚠️ Сервер не ответил — плашка обновится при следующем опросе"
+        else:
+            message = await update_text_embed(server_id, data, PRIORITY_INTERACTION)
+            snapshot = cache.get_stale(server["ip"], server["port"])
+            if message is None and not server.get("shared_panel"):
+                # update_text_embed сам логирует причину и возвращает None, если плашку опубликовать не удалось
+                status = "⚠️ Не удалось обновить плашку — она обновится при следующем опросе"
+            else:
+                status = f"✅ Плашка обновлена • {as_of(snapshot[1])}" if snapshot else "✅ Плашка обновлена"
+        await edit_response(interaction, **with_status(response, status))
+    except Exception as e:
+        commands_log.warning("Не удалось обновить плашку #%s после команды: %s", server_id, e)
 
 # ==================== SLASH-КОМАНДЫ ====================
 @tree.command(name="voice_test", description="Тест обновления голосового канала")
@@ -457,39 +2888,50 @@ async def voice_test(interaction: discord.Interaction, server_id: int):
         await interaction.response.send_message("❌ Сервер не найден", ephemeral=True)
         return
     
-    await interaction.response.defer(ephemeral=True)
-    
     server = config.servers[server_id]
     
     if not server.get("voice_channel_id"):
-        await interaction.followup.send("❌ Голосовой канал не настроен", ephemeral=True)
-        return
-    
-    data = await get_server_info(server["ip"], server["port"])
-    
-    if not data:
-        await interaction.followup.send("❌ Не удалось получить данные сервера", ephemeral=True)
+        await interaction.response.send_message("❌ Голосовой канал не настроен", ephemeral=True)
         return
-    
-    try:
-        await update_voice_channel_name(server_id, data)
-        
+
+    # Что решило обновление по свежим данным: имя, которое будет у канала (None — автообновление выключено)
+    planned = {}
+
+    def apply(data):
+        planned["name"] = update_voice_channel_name(server_id, data)
+
+    def render(data):
+        if not data:
+            return {"content": "❌ Не удалось получить данные сервера"}
+
         channel = client.get_channel(server["voice_channel_id"])
-        if channel:
-            await interaction.followup.send(
-                f"✅ Голосовой канал обновлен\n"
+        if not channel:
+            return {"content": "⚠️ Канал не найден, но функция обновления выполнена"}
+
+        if "name" not in planned:
+            # Ответ по снимку из кэша: переименование ещё не планировалось
+            return {"content":
+                f"🔎 Проверяю сервер...\n"
                 f"**Текущее имя:** {channel.name}\n"
-                f"**Онлайн:** {data['online']}/{data['max']}",
-                ephemeral=True
-            )
+                f"**Онлайн:** {data['online']}/{data['max']}"
+            }
+
+        new_name = planned["name"]
+        if new_name is None:
+            status = "ℹ️ Автообновление имени выключено"
+        elif channel.name == new_name:
+            status = "✅ Имя уже актуально"
         else:
-            await interaction.followup.send(
-                f"⚠️ Канал не найден, но функция обновления выполнена",
-                ephemeral=True
-            )
-            
-    except Exception as e:
-        await interaction.followup.send(f"❌ Ошибка: {e}", ephemeral=True)
+            status = "⏳ Переименование запланировано (Discord разрешает 2 переименования за 10 минут)"
+        return {"content":
+            f"{status}\n"
+            f"**Текущее имя:** {channel.name}\n"
+            f"**Новое имя:** {new_name or '—'}\n"
+            f"**Онлайн:** {data['online']}/{data['max']}"
+        }
+
+    # Переименование планируется только по свежим данным
+    await respond_with_snapshot(interaction, server, render, on_fresh=apply)
 
 @tree.command(name="design_preview", description="Предпросмотр разных дизайнов плашки")
 @app_commands.describe(
@@ -510,35 +2952,29 @@ async def design_preview(
         await interaction.response.send_message("❌ Сервер не найден", ephemeral=True)
         return
     
-    await interaction.response.defer(ephemeral=True)
-    
     server = config.servers[server_id]
-    data = await get_server_info(server["ip"], server["port"])
-    
-    if not data:
-        await interaction.followup.send("❌ Не удалось получить данные сервера", ephemeral=True)
-        return
-    
-    if design == "new":
-        embed = create_new_embed(server_id, server, data)
-        embed.set_footer(text=f"{embed.footer.text} • Предпросмотр нового дизайна")
-    else:
-        embed = create_old_embed(server_id, server, data)
-        embed.set_footer(text=f"{embed.footer.text} • Предпросмотр старого дизайна")
-    
     design_names = {"old": "📊 Старый дизайн", "new": "🎨 Новый дизайн"}
-    
-    await interaction.followup.send(
-        content=f"👁️ **Предпросмотр: {design_names[design]}**",
-        embed=embed,
-        ephemeral=True
-    )
+
+    def render(data):
+        if not data:
+            return {"content": "❌ Не удалось получить данные сервера"}
+
+        if design == "new":
+            embed = create_new_embed(server_id, server, data)
+            embed.set_footer(text=f"{embed.footer.text} • Предпросмотр нового дизайна")
+        else:
+            embed = create_old_embed(server_id, server, data)
+            embed.set_footer(text=f"{embed.footer.text} • Предпросмотр старого дизайна")
+        return {"content": f"👁️ **Предпросмотр: {design_names[design]}**", "embed": embed}
+
+    await respond_with_snapshot(interaction, server, render)
 
 @tree.command(name="design_set", description="Сменить дизайн плашки")
 @app_commands.describe(
     server_id="ID сервера",
     design="Тип дизайна",
-    image_url="URL изображения для нового дизайна (опционально)"
+    image_url="URL изображения для нового дизайна (опционально)",
+    show_chart="Показывать график онлайна вместо изображения (только новый дизайн)"
 )
 @app_commands.choices(design=[
     app_commands.Choice(name="📊 Старый дизайн (компактный)", value="old"),
@@ -548,7 +2984,8 @@ async def design_set(
     interaction: discord.Interaction,
     server_id: int,
     design: str,
-    image_url: Optional[str] = None
+    image_url: Optional[str] = None,
+    show_chart: Optional[bool] = None
 ):
     """Устанавливает дизайн плашки сервера"""
     if server_id not in config.servers:
@@ -567,13 +3004,12 @@ async def design_set(
                 ephemeral=True
             )
             return
+
+    if show_chart is not None:
+        server["show_chart"] = show_chart
     
     config.save_config()
     
-    data = await get_server_info(server["ip"], server["port"])
-    if data:
-        await update_text_embed(server_id, data)
-    
     design_names = {"old": "📊 Старый дизайн", "new": "🎨 Новый дизайн"}
     
     embed = discord.Embed(
@@ -584,12 +3020,14 @@ async def design_set(
     embed.add_field(name="ID", value=str(server_id), inline=True)
     embed.add_field(name="Дизайн", value=design_names[design], inline=True)
     
+    if design == "new" and server.get("show_chart"):
+        embed.add_field(name="График онлайна", value="✅ Включён", inline=False)
     if design == "new" and server.get("image_url"):
         embed.add_field(name="Изображение", value="✅ Установлено", inline=False)
         if image_url:
             embed.set_image(url=image_url)
     
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await respond_and_refresh_panel(interaction, server_id, embed=embed)
 
 @tree.command(name="server_add", description="Добавить новый сервер для мониторинга")
 @app_commands.describe(
@@ -605,7 +3043,7 @@ async def server_add(interaction: discord.Interaction, ip: str, port: int, name:
     # Проверка на дубликат
     for sid, server in config.servers.items():
         if server["ip"] == ip and server["port"] == port:
-            await interaction.followup.send(
+            await send_followup(interaction,
                 f"⚠️ Сервер `{ip}:{port}` уже добавлен (ID: {sid}).",
                 ephemeral=True
             )
@@ -613,7 +3051,7 @@ async def server_add(interaction: discord.Interaction, ip: str, port: int, name:
 
     data = await get_server_info(ip, port)
     if not data:
-        await interaction.followup.send(
+        await send_followup(interaction,
             f"❌ Не удалось подключиться к `{ip}:{port}`. Проверьте IP и порт.",
             ephemeral=True
         )
@@ -622,7 +3060,7 @@ async def server_add(interaction: discord.Interaction, ip: str, port: int, name:
     server_id = config.add_server(ip, port, name, display_port)
     
     if server_id is None:
-        await interaction.followup.send(
+        await send_followup(interaction,
             "❌ Не удалось добавить сервер. Возможно, он уже существует.",
             ephemeral=True
         )
@@ -644,7 +3082,7 @@ async def server_add(interaction: discord.Interaction, ip: str, port: int, name:
                    inline=False)
     embed.add_field(name="Текущий онлайн", value=f"{data['online']}/{data['max']}", inline=False)
 
-    await interaction.followup.send(embed=embed, ephemeral=True)
+    await send_followup(interaction, embed=embed, ephemeral=True)
 
 @tree.command(name="clear_cache", description="Очистить кэш запросов")
 async def clear_cache(interaction: discord.Interaction):
@@ -661,7 +3099,7 @@ async def server_list(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True, thinking=True)
 
     if not config.servers:
-        await interaction.followup.send(
+        await send_followup(interaction,
             "📭 Список серверов пуст. Добавьте сервер командой `/server_add`.",
             ephemeral=True
         )
@@ -692,7 +3130,7 @@ async def server_list(interaction: discord.Interaction):
             inline=False
         )
 
-    await interaction.followup.send(embed=embed, ephemeral=True)
+    await send_followup(interaction, embed=embed, ephemeral=True)
 
 @tree.command(name="set_display_port", description="Изменить отображаемый порт")
 @app_commands.describe(
@@ -715,16 +3153,11 @@ async def set_display_port(interaction: discord.Interaction, server_id: int, dis
     
     config.save_config()
     
-    # Обновляем плашку
-    data = await get_server_info(server["ip"], server["port"])
-    if data:
-        await update_text_embed(server_id, data)
-    
-    await interaction.response.send_message(
+    # Плашка обновляется в фоне, ответ приходит сразу
+    await respond_and_refresh_panel(interaction, server_id, content=
         f"✅ Отображаемый порт для **{server['name']}** изменён:\n"
         f"**Было:** `{server['ip']}:{old_port}`\n"
-        f"**Стало:** `{server['ip']}:{display_port}`",
-        ephemeral=True
+        f"**Стало:** `{server['ip']}:{display_port}`"
     )
 
 @tree.command(name="server_set_channel", description="Настроить каналы для отображения")
@@ -765,12 +3198,21 @@ async def server_set_channel(
         return
 
     server = config.servers[server_id]
+    old_channel_id = server.get("text_channel_id")
+    old_message_id = server.get("message_id")
+    moved = channel_type == "text" and old_channel_id != channel.id
 
     if channel_type == "text":
         server["text_channel_id"] = channel.id
     else:
         server["voice_channel_id"] = channel.id
 
+    # Плашка и её отпечаток относятся к старому каналу — в новом публикуем заново
+    if moved:
+        config.set_runtime(server_id, "message_id", None)
+        published_embeds.pop(server_id, None)
+        chart_uploads.pop(old_message_id, None)
+
     config.save_config()
 
     await interaction.response.send_message(
@@ -780,9 +3222,16 @@ async def server_set_channel(
     )
 
     try:
+        if moved and old_channel_id:
+            old_channel = client.get_channel(old_channel_id)
+            if old_message_id and isinstance(old_channel, discord.TextChannel):
+                await delete_panel_message(old_channel, old_message_id)
+            # Убираем сервер с общей плашки старого канала
+            if server.get("shared_panel"):
+                await update_channel_panels(old_channel_id, PRIORITY_INTERACTION)
         await update_server_status(server_id)
     except Exception as e:
-        print(f"[SET_CHANNEL] Ошибка обновления после настройки канала: {e}")
+        commands_log.error("Ошибка обновления после настройки канала: %s", e)
 
 @tree.command(name="server_test", description="Протестировать подключение к серверу")
 @app_commands.describe(server_id="ID сервера")
@@ -795,32 +3244,27 @@ async def server_test(interaction: discord.Interaction, server_id: int):
         )
         return
 
-    await interaction.response.defer(ephemeral=True, thinking=True)
-
     server = config.servers[server_id]
-    data = await get_server_info(server["ip"], server["port"])
 
-    if not data:
-        await interaction.followup.send(
-            f"❌ Сервер **{server['name']}** не отвечает.",
-            ephemeral=True
-        )
-        return
+    def render(data):
+        if not data:
+            return {"content": f"❌ Сервер **{server['name']}** не отвечает."}
 
-    embed = discord.Embed(
-        title=f"📊 Тест сервера #{server_id}",
-        color=discord.Color.green(),
-        timestamp=datetime.now()
-    )
-    
-    display_port = server.get("display_port", server["port"])
-    embed.add_field(name="Название", value=data["name"], inline=True)
-    embed.add_field(name="Онлайн", value=f"{data['online']}/{data['max']}", inline=True)
-    embed.add_field(name="Запросный порт", value=f"`{server['port']}`", inline=False)
-    embed.add_field(name="Отображаемый порт", value=f"`{display_port}`", inline=True)
-    embed.add_field(name="Адрес для плашки", value=f"`{server['ip']}:{display_port}`", inline=False)
+        embed = discord.Embed(
+            title=f"📊 Тест сервера #{server_id}",
+            color=discord.Color.green()
+        )
+        
+        display_port = server.get("display_port", server["port"])
+        embed.add_field(name="Название", value=data["name"], inline=True)
+        embed.add_field(name="Онлайн", value=f"{data['online']}/{data['max']}", inline=True)
+        embed.add_field(name="Запросный порт", value=f"`{server['port']}`", inline=False)
+        embed.add_field(name="Отображаемый порт", value=f"`{display_port}`", inline=True)
+        embed.add_field(name="Адрес для плашки", value=f"`{server['ip']}:{display_port}`", inline=False)
+        return {"embed": embed}
 
-    await interaction.followup.send(embed=embed, ephemeral=True)
+    # Сначала последний снимок, затем результат живого запроса правкой ответа
+    await respond_with_snapshot(interaction, server, render)
 
 @tree.command(name="server_remove", description="Удалить сервер из мониторинга")
 @app_commands.describe(server_id="ID сервера")
@@ -834,24 +3278,40 @@ async def server_remove(interaction: discord.Interaction, server_id: int):
         return
 
     server_name = config.servers[server_id]["name"]
-    
-    if config.servers[server_id].get("text_channel_id") and config.servers[server_id].get("message_id"):
-        try:
-            channel = client.get_channel(config.servers[server_id]["text_channel_id"])
-            if channel:
-                message = await channel.fetch_message(config.servers[server_id]["message_id"])
-                await message.delete()
-        except:
-            pass
-
-    del config.servers[server_id]
-    config.save_config()
+    channel_id = config.servers[server_id].get("text_channel_id")
+    shared = config.servers[server_id].get("shared_panel")
+    message_id = config.servers[server_id].get("message_id")
+    voice_channel_id = config.servers[server_id].get("voice_channel_id")
+    channel = client.get_channel(channel_id) if channel_id else None
+
+    published_embeds.pop(server_id, None)
+    chart_uploads.pop(message_id, None)
+    # Отложенное переименование голосового канала удалённого сервера больше не нужно
+    if voice_channel_id:
+        voice_renamer.cancel(voice_channel_id)
+    config.remove_server(server_id)
+    breakers.pop(server_id, None)
+    histories.pop(server_id, None)
+    last_charts.pop(server_id, None)
+    stats_store.delete_server(server_id)
+    last_snapshots.pop(server_id, None)
+    panel_throttle.forget(server_id)
 
     await interaction.response.send_message(
         f"✅ Сервер **{server_name}** (ID: {server_id}) удалён.",
         ephemeral=True
     )
 
+    # Плашки убираем уже после ответа: запросы к Discord могут ждать в очереди дольше 3 секунд
+    async def cleanup():
+        if message_id and isinstance(channel, discord.TextChannel):
+            await delete_panel_message(channel, message_id)
+        # Убираем сервер с общей плашки канала
+        if shared and channel_id:
+            await update_channel_panels(channel_id, PRIORITY_INTERACTION)
+
+    spawn_command_task(cleanup())
+
 @tree.command(name="server_customize", description="Настроить внешний вид плашки")
 @app_commands.describe(
     server_id="ID сервера",
@@ -861,7 +3321,9 @@ async def server_remove(interaction: discord.Interaction, server_id: int):
     show_address="Показывать адрес?",
     display_port="Порт для отображения (если отличается)",
     thumbnail_url="URL картинки для thumbnail",
-    footer_text="Текст в подвале"
+    footer_text="Текст в подвале",
+    shared_panel="Показывать сервер на общей плашке канала (до 10 серверов в одном сообщении)?",
+    voice_bucket="Шаг онлайна для имени голосового канала (меньшие изменения не переименовывают канал)"
 )
 async def server_customize(
     interaction: discord.Interaction,
@@ -872,7 +3334,9 @@ async def server_customize(
     show_address: bool = None,
     display_port: Optional[int] = None,
     thumbnail_url: str = None,
-    footer_text: str = None
+    footer_text: str = None,
+    shared_panel: bool = None,
+    voice_bucket: Optional[int] = None
 ):
     """Кастомизирует внешний вид плашки (без карты)"""
     if server_id not in config.servers:
@@ -927,12 +3391,28 @@ async def server_customize(
         server["footer_text"] = footer_text
         changes.append(f"**Подвал:** `{footer_text}`")
 
+    if voice_bucket is not None:
+        if voice_bucket < 1:
+            await interaction.response.send_message(
+                "❌ Шаг онлайна должен быть не меньше 1.",
+                ephemeral=True
+            )
+            return
+        server["voice_bucket"] = voice_bucket
+        changes.append(f"**Шаг онлайна в голосовом канале:** {voice_bucket}")
+
+    panel_switched = shared_panel is not None and shared_panel != bool(server.get("shared_panel"))
+    if panel_switched:
+        server["shared_panel"] = shared_panel
+        changes.append(f"**Общая плашка:** {'включена' if shared_panel else 'выключена'}")
+
     config.save_config()
-    
-    # Обновляем плашку
-    data = await get_server_info(server["ip"], server["port"])
-    if data:
-        await update_text_embed(server_id, data)
+
+    async def switch_panel():
+        # Отдельная плашка больше не нужна, а общая плашка канала меняет состав
+        if shared_panel:
+            await delete_server_message(server_id)
+        await update_channel_panels(server["text_channel_id"], PRIORITY_INTERACTION)
 
     embed = discord.Embed(
         title="✅ Настройки плашки обновлены",
@@ -945,6 +3425,186 @@ async def server_customize(
     else:
         embed.add_field(name="ℹ️", value="Никаких изменений не было применено.", inline=False)
 
+    await respond_and_refresh_panel(interaction, server_id, prepare=switch_panel if panel_switched else None, embed=embed)
+
+@tree.command(name="server_update_rules", description="Настроить, как часто обновляется плашка")
+@app_commands.describe(
+    server_id="ID сервера",
+    min_delta="Обновлять плашку, только если онлайн изменился хотя бы на столько игроков",
+    edit_on_bar_change="Обновлять плашку, когда заметно меняется прогресс-бар (даже при меньшем изменении)",
+    min_edit_interval="Минимальный интервал между правками плашки (секунды)",
+    max_staleness="Через сколько секунд обновлять плашку в любом случае"
+)
+async def server_update_rules(
+    interaction: discord.Interaction,
+    server_id: int,
+    min_delta: Optional[int] = None,
+    edit_on_bar_change: bool = None,
+    min_edit_interval: Optional[int] = None,
+    max_staleness: Optional[int] = None
+):
+    """Настраивает гистерезис и интервалы обновления плашки сервера"""
+    if server_id not in config.servers:
+        await interaction.response.send_message("❌ Сервер не найден", ephemeral=True)
+        return
+
+    server = config.servers[server_id]
+    new_interval = server.get("min_edit_interval", 0) if min_edit_interval is None else min_edit_interval
+    new_staleness = server.get("max_staleness", PANEL_MAX_STALENESS) if max_staleness is None else max_staleness
+
+    if min_delta is not None and min_delta < 1:
+        await interaction.response.send_message("❌ Порог онлайна должен быть не меньше 1.", ephemeral=True)
+        return
+    if new_interval < 0 or new_staleness < new_interval:
+        await interaction.response.send_message(
+            "❌ Интервал должен быть неотрицательным и не больше максимальной задержки.",
+            ephemeral=True
+        )
+        return
+
+    changes = []
+    if min_delta is not None:
+        server["min_delta"] = min_delta
+        changes.append(f"**Порог онлайна:** {min_delta}")
+    if edit_on_bar_change is not None:
+        server["edit_on_bar_change"] = edit_on_bar_change
+        changes.append(f"**Правка при смене прогресс-бара:** {'включена' if edit_on_bar_change else 'выключена'}")
+    if min_edit_interval is not None:
+        server["min_edit_interval"] = min_edit_interval
+        changes.append(f"**Минимальный интервал:** {min_edit_interval} сек.")
+    if max_staleness is not None:
+        server["max_staleness"] = max_staleness
+        changes.append(f"**Максимальная задержка:** {max_staleness} сек.")
+
+    config.save_config()
+
+    embed = discord.Embed(
+        title="✅ Правила обновления плашки",
+        description=f"Сервер **{server['name']}** (ID: {server_id}):",
+        color=discord.Color.green()
+    )
+    embed.add_field(
+        name="Текущие правила",
+        value=(
+            f"Порог онлайна: **{server['min_delta']}**\n"
+            f"Правка при смене прогресс-бара: **{'да' if server['edit_on_bar_change'] else 'нет'}**\n"
+            f"Минимальный интервал: **{server['min_edit_interval']}** сек.\n"
+            f"Максимальная задержка: **{server['max_staleness']}** сек."
+        ),
+        inline=False
+    )
+    if changes:
+        embed.add_field(name="Применённые изменения", value="\n".join(changes), inline=False)
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name="server_history", description="Статистика онлайна сервера за период")
+@app_commands.describe(
+    server_id="ID сервера",
+    window="Период"
+)
+@app_commands.choices(window=[
+    app_commands.Choice(name="Последний час", value=3600),
+    app_commands.Choice(name="Последние 6 часов", value=6 * 3600),
+    app_commands.Choice(name="Последние сутки", value=86400),
+    app_commands.Choice(name="Последняя неделя", value=7 * 86400),
+    app_commands.Choice(name="Последние 30 дней", value=30 * 86400),
+    app_commands.Choice(name="Последний год", value=365 * 86400)
+])
+async def server_history(interaction: discord.Interaction, server_id: int, window: int = 86400):
+    """Показывает минимум, средний и пиковый онлайн сервера за выбранный период"""
+    if server_id not in config.servers:
+        await interaction.response.send_message("❌ Сервер не найден", ephemeral=True)
+        return
+
+    server = config.servers[server_id]
+    history = histories.get(server_id)
+    summary = history.summary(window) if history else None
+    if not summary:
+        await interaction.response.send_message(
+            f"ℹ️ Для **{server['name']}** пока нет истории онлайна за этот период.",
+            ephemeral=True
+        )
+        return
+
+    embed = discord.Embed(
+        title=f"📈 История онлайна: {server['name']}",
+        description=f"Данные с <t:{summary['since']}:f>",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="⬇️ Минимум", value=f"**{summary['min']}**/{summary['max']}", inline=True)
+    embed.add_field(name="➗ В среднем", value=f"**{summary['avg']:.1f}**/{summary['max']}", inline=True)
+    embed.add_field(name="⬆️ Пик", value=f"**{summary['peak']}**/{summary['max']}", inline=True)
+    embed.set_footer(text=f"Замеров: {summary['samples']} • 🆔: {server_id}")
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name="server_stats", description="Статистика сервера за день или неделю")
+@app_commands.describe(
+    server_id="ID сервера",
+    period="Период"
+)
+@app_commands.choices(period=[
+    app_commands.Choice(name="Сегодня", value="today"),
+    app_commands.Choice(name="Вчера", value="yesterday"),
+    app_commands.Choice(name="Эта неделя", value="week"),
+    app_commands.Choice(name="Прошлая неделя", value="last_week")
+])
+async def server_stats(interaction: discord.Interaction, server_id: int, period: str = "today"):
+    """Показывает пик, средний онлайн, аптайм и онлайн по часам из готовой сводки"""
+    if server_id not in config.servers:
+        await interaction.response.send_message("❌ Сервер не найден", ephemeral=True)
+        return
+
+    # Свежие опросы ещё могли не попасть в базу
+    stats_store.flush()
+
+    now = datetime.now()
+    if period == "yesterday":
+        key = StatsStore.periods(now - timedelta(days=1))[0]
+    elif period == "week":
+        key = StatsStore.periods(now)[1]
+    elif period == "last_week":
+        key = StatsStore.periods(now - timedelta(days=7))[1]
+    else:
+        key = StatsStore.periods(now)[0]
+
+    server = config.servers[server_id]
+    stats = stats_store.get(server_id, key)
+    if not stats:
+        await interaction.response.send_message(
+            f"ℹ️ Для **{server['name']}** нет статистики за `{key.split(':', 1)[1]}`.",
+            ephemeral=True
+        )
+        return
+
+    embed = discord.Embed(
+        title=f"📊 Статистика: {server['name']}",
+        description=f"Период: `{key.split(':', 1)[1]}`",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="⬆️ Пик", value=f"**{stats['peak']}**/{stats['max']}", inline=True)
+    embed.add_field(name="➗ В среднем", value=f"**{stats['avg']:.1f}**/{stats['max']}", inline=True)
+    embed.add_field(name="✅ Аптайм", value=f"**{stats['uptime']:.1f}%**", inline=True)
+
+    # Онлайн по часам суток: столбик на каждый час
+    known = [value for value in stats["by_hour"] if value is not None]
+    if known:
+        levels = "▁▂▃▄▅▆▇█"
+        top = max(known) or 1
+        chart = "".join(
+            " " if value is None else levels[min(len(levels) - 1, int(value / top * (len(levels) - 1)))]
+            for value in stats["by_hour"]
+        )
+        busiest = max(range(24), key=lambda hour: stats["by_hour"][hour] or 0)
+        embed.add_field(
+            name="🕐 Онлайн по часам",
+            value=f"`{chart}`\n`0     6     12    18   23`\n"
+                  f"Самый людный час: **{busiest:02d}:00** (≈{stats['by_hour'][busiest]:.1f})",
+            inline=False
+        )
+
+    embed.set_footer(text=f"Опросов: {stats['samples']} • 🆔: {server_id}")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @tree.command(name="server_preview", description="Предпросмотр текущего вида плашки")
@@ -959,56 +3619,48 @@ async def server_preview(interaction: discord.Interaction, server_id: int):
         return
 
     server = config.servers[server_id]
-    data = await get_server_info(server["ip"], server["port"])
 
-    if not data:
-        await interaction.response.send_message(
-            f"❌ Не удалось получить данные с сервера.",
-            ephemeral=True
-        )
-        return
+    def render(data):
+        if not data:
+            return {"content": "❌ Не удалось получить данные с сервера."}
 
-    title = server["embed_title"]
-    title = title.replace("{name}", server["name"])
-    title = title.replace("{online}", str(data["online"]))
-    title = title.replace("{max}", str(data["max"]))
+        title = server["embed_title"]
+        title = title.replace("{name}", server["name"])
+        title = title.replace("{online}", str(data["online"]))
+        title = title.replace("{max}", str(data["max"]))
 
-    embed = discord.Embed(
-        title=title,
-        color=int(server.get("embed_color", "00FF00"), 16),
-        timestamp=datetime.now()
-    )
+        embed = discord.Embed(
+            title=title,
+            color=int(server.get("embed_color", "00FF00"), 16)
+        )
 
-    if server.get("show_progress", True):
-        if data["max"] > 0:
-            percentage = (data["online"] / data["max"]) * 100
-            bar_length = 10
-            filled = int(bar_length * (data["online"] / data["max"]))
-            progress_bar = "█" * filled + "░" * (bar_length - filled)
-            embed.add_field(name="👥 Онлайн", value=f"**{data['online']}**/{data['max']}", inline=True)
-            embed.add_field(name="📊 Заполненность", value=f"{progress_bar} {percentage:.1f}%", inline=True)
+        if server.get("show_progress", True):
+            if data["max"] > 0:
+                percentage = (data["online"] / data["max"]) * 100
+                bar_length = PROGRESS_BAR_LENGTH["old"]
+                filled = int(bar_length * (data["online"] / data["max"]))
+                progress_bar = "█" * filled + "░" * (bar_length - filled)
+                embed.add_field(name="👥 Онлайн", value=f"**{data['online']}**/{data['max']}", inline=True)
+                embed.add_field(name="📊 Заполненность", value=f"{progress_bar} {percentage:.1f}%", inline=True)
+            else:
+                embed.add_field(name="👥 Онлайн", value=f"**{data['online']}**/0", inline=True)
         else:
-            embed.add_field(name="👥 Онлайн", value=f"**{data['online']}**/0", inline=True)
-    else:
-        embed.add_field(name="👥 Онлайн", value=f"**{data['online']}**/{data['max']}", inline=False)
+            embed.add_field(name="👥 Онлайн", value=f"**{data['online']}**/{data['max']}", inline=False)
 
-    if server.get("show_map", True):
-        embed.add_field(name="🗺️ Карта", value=data["map"], inline=False)
+        if server.get("show_map", True):
+            embed.add_field(name="🗺️ Карта", value=data["map"], inline=False)
 
-    if server.get("show_address", True):
-        embed.add_field(name="🌐 Адрес", value=f"`{server['ip']}:{server['port']}`", inline=False)
+        if server.get("show_address", True):
+            embed.add_field(name="🌐 Адрес", value=f"`{server['ip']}:{server['port']}`", inline=False)
 
-    if server.get("thumbnail_url"):
-        embed.set_thumbnail(url=server["thumbnail_url"])
+        if server.get("thumbnail_url"):
+            embed.set_thumbnail(url=server["thumbnail_url"])
 
-    footer_text = server.get("footer_text", "Обновлено")
-    embed.set_footer(text=f"{footer_text} • 🆔: {server_id} • Предпросмотр")
+        footer_text = server.get("footer_text", "Обновлено")
+        embed.set_footer(text=f"{footer_text} • 🆔: {server_id} • Предпросмотр")
+        return {"content": "👁️ **Предпросмотр плашки** (так она выглядит в канале):", "embed": embed}
 
-    await interaction.response.send_message(
-        content="👁️ **Предпросмотр плашки** (так она выглядит в канале):",
-        embed=embed,
-        ephemeral=True
-    )
+    await respond_with_snapshot(interaction, server, render)
 
 @tree.command(name="bot_help", description="Показать справку по командам")
 async def bot_help(interaction: discord.Interaction):
@@ -1025,7 +3677,10 @@ async def bot_help(interaction: discord.Interaction):
         ("`/server_set_channel <id> <тип> <канал>`", "Настроить каналы"),
         ("`/server_test <id>`", "Протестировать подключение"),
         ("`/server_customize <id> [опции...]`", "Настроить вид плашки"),
-        ("`/design_set <id> <дизайн> [изображение]`", "Сменить дизайн плашки"),
+        ("`/server_update_rules <id> [опции...]`", "Настроить частоту обновления плашки"),
+        ("`/server_history <id> [период]`", "Минимум, средний и пиковый онлайн"),
+        ("`/server_stats <id> [период]`", "Статистика за день или неделю"),
+        ("`/design_set <id> <дизайн> [изображение] [график]`", "Сменить дизайн плашки"),
         ("`/design_preview <id> <дизайн>`", "Предпросмотр дизайна"),
         ("`/voice_test <id>`", "Тест голосового канала"),
         ("`/clear_cache`", "Очистить кэш запросов"),
@@ -1059,81 +3714,291 @@ async def panel_recreate(interaction: discord.Interaction, server_id: int):
     server = config.servers[server_id]
     
     if not server.get("text_channel_id"):
-        await interaction.followup.send(
+        await send_followup(interaction,
             "❌ У этого сервера не настроен текстовый канал. Используйте `/server_set_channel`",
             ephemeral=True
         )
         return
     
-    data = await get_server_info(server["ip"], server["port"])
+    # Плашку собираем из последнего снимка; свежий онлайн принесёт ближайший опрос
+    data = await get_server_info(server["ip"], server["port"], allow_stale=True)
     
     if not data:
-        await interaction.followup.send("❌ Не удалось получить данные сервера", ephemeral=True)
+        await send_followup(interaction, "❌ Не удалось получить данные сервера", ephemeral=True)
         return
     
     channel = client.get_channel(server["text_channel_id"])
     if not isinstance(channel, discord.TextChannel):
-        await interaction.followup.send("❌ Канал не найден или не текстовый", ephemeral=True)
+        await send_followup(interaction, "❌ Канал не найден или не текстовый", ephemeral=True)
+        return
+
+    if server.get("shared_panel"):
+        last_snapshots[server_id] = data
+        await recreate_channel_panels(channel.id)
+        await send_followup(interaction,
+            f"✅ Общая плашка канала {channel.mention} пересоздана",
+            ephemeral=True
+        )
         return
     
     if server.get("message_id"):
         try:
-            old_message = await channel.fetch_message(server["message_id"])
-            await old_message.delete()
-            print(f"[RECREATE] Удалена старая плашка #{server['message_id']}")
+            old_message = channel.get_partial_message(server["message_id"])
+            await discord_scheduler.submit(
+                f"message:{channel.id}", old_message.delete, PRIORITY_INTERACTION
+            )
+            commands_log.info("Удалена старая плашка #%s", server["message_id"])
         except discord.NotFound:
-            print(f"[RECREATE] Старая плашка уже удалена")
+            commands_log.info("Старая плашка уже удалена")
         except Exception as e:
-            print(f"[RECREATE] Ошибка удаления старой плашки: {e}")
+            commands_log.warning("Ошибка удаления старой плашки: %s", e)
     
-    design = server.get("design", "old")
-    if design == "new":
-        embed = create_new_embed(server_id, server, data)
-    else:
-        embed = create_old_embed(server_id, server, data)
+    chart = await prepare_chart(channel.id, server_id, server, data)
+    charts = [chart] if chart else []
+    embed = create_server_embed(server_id, server, data, chart)
     
     try:
-        new_message = await channel.send(embed=embed)
-        server["message_id"] = new_message.id
-        config.save_config()
+        new_message = await discord_scheduler.submit(
+            f"message:{channel.id}", lambda: channel.send(embed=embed, **chart_kwargs(None, charts)), PRIORITY_INTERACTION
+        )
+        remember_charts(new_message.id, charts)
+        config.set_runtime(server_id, "message_id", new_message.id)
+        published_embeds[server_id] = embed_fingerprint(embed)
         
-        await interaction.followup.send(
+        await send_followup(interaction,
             f"✅ Плашка сервера **{server['name']}** пересоздана\n"
             f"**Канал:** {channel.mention}\n"
             f"**Ссылка:** {new_message.jump_url}",
             ephemeral=True
         )
     except Exception as e:
-        await interaction.followup.send(f"❌ Ошибка при создании плашки: {e}", ephemeral=True)
+        await send_followup(interaction, f"❌ Ошибка при создании плашки: {e}", ephemeral=True)
+
+# ==================== ТЁПЛЫЙ СТАРТ ====================
+def monotonic_offset() -> float:
+    """Разница между time.time() и time.monotonic() — для перевода сроков между запусками"""
+    return time.time() - time.monotonic()
+
+def save_snapshot():
+    """Сохраняет кэш A2S, расписание опросов и отпечатки плашек, чтобы после перезапуска не начинать с нуля"""
+    offset = monotonic_offset()
+    now = time.monotonic()
+    snapshot = {
+        "saved_at": time.time(),
+        # ip:port -> [снимок, время снимка]
+        "cache": {
+            key: [entry.data, entry.timestamp]
+            for key, entry in cache.cache.items() if entry.data is not None
+        },
+        # server_id -> [срок опроса, последние значения онлайна]
+        "polls": {
+            server_id: [due + offset, list(poll_scheduler._samples.get(server_id, ()))]
+            for server_id, due in poll_scheduler._due.items()
+        },
+        # server_id -> [id сообщения, отпечаток]; отпечаток действителен только для этого сообщения
+        "embeds": {
+            server_id: [config.servers[server_id].get("message_id"), fingerprint]
+            for server_id, fingerprint in published_embeds.items() if server_id in config.servers
+        },
+        "panels": {
+            scope: [state_store.get(scope, "message_id"), fingerprint]
+            for scope, fingerprint in published_panels.items()
+        },
+        "charts": {message_id: list(names) for message_id, names in chart_uploads.items()},
+        "snapshots": last_snapshots,
+        # server_id -> [снимок на плашке, сколько секунд он уже показан]
+        "shown": {server_id: [data, now - at] for server_id, (data, at) in panel_throttle.shown.items()},
+        # server_id -> сколько секунд назад плашку последний раз правили
+        "edited": {server_id: now - at for server_id, at in panel_throttle.edited.items()},
+        # channel_id -> [время последних переименований, состояние в имени]
+        "voice": {
+            channel_id: [[at + offset for at in budget.history], budget.shown]
+            for channel_id, budget in voice_renamer.budgets.items()
+        }
+    }
+
+    tmp_file = f"{SNAPSHOT_FILE}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_file, SNAPSHOT_FILE)
+        snapshot_log.info("Снимок сохранён: %d адресов в кэше, %d плашек", len(snapshot["cache"]), len(snapshot["embeds"]))
+    except Exception as e:
+        snapshot_log.error("Ошибка сохранения снимка: %s", e)
 
-# ==================== ЗАПУСК БОТА ====================
-@client.event
-async def on_ready():
-    print(f"✅ Бот {client.user} запущен!")
-    print(f"📊 Загружено серверов: {len(config.servers)}")
-    print(f"🌐 Бот находится на {len(client.guilds)} серверах")
+def load_snapshot():
+    """Восстанавливает состояние из снимка: первый цикл после перезапуска работает как обычный"""
+    try:
+        with open(SNAPSHOT_FILE, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        snapshot_log.error("Ошибка чтения снимка: %s", e)
+        return
+    finally:
+        # Снимок одноразовый: после аварийного завершения нельзя верить отпечаткам предыдущего запуска
+        try:
+            os.remove(SNAPSHOT_FILE)
+        except OSError:
+            pass
+
+    downtime = time.time() - snapshot.get("saved_at", 0)
+    if not 0 <= downtime <= SNAPSHOT_MAX_AGE:
+        snapshot_log.info("Снимок устарел (%.0fс), запускаюсь с пустым состоянием", downtime)
+        return
+
+    offset = monotonic_offset()
+    now = time.monotonic()
+
+    for key, (data, timestamp) in snapshot.get("cache", {}).items():
+        entry = cache._entry(key, create=True)
+        entry.data = data
+        entry.timestamp = timestamp
+
+    # Сроки опросов сохраняются; просроченные за время простоя расходятся по своим фазам, а не все сразу
+    overdue = []
+    for server_id, (due, samples) in snapshot.get("polls", {}).items():
+        server_id = int(server_id)
+        if server_id not in config.servers:
+            continue
+        for online in samples:
+            poll_scheduler.record(server_id, online)
+        if due - offset > now:
+            poll_scheduler.schedule(server_id, due - offset)
+        else:
+            overdue.append((due, server_id))
+    for _, server_id in overdue:
+        poll_scheduler.schedule(server_id, poll_scheduler.aligned(server_id, now, poll_scheduler.default_interval))
+
+    # Отпечатки берём только для тех сообщений, id которых не поменялся, — иначе сверимся заново
+    for server_id, (message_id, fingerprint) in snapshot.get("embeds", {}).items():
+        server = config.servers.get(int(server_id))
+        if server and message_id and server.get("message_id") == message_id:
+            published_embeds[int(server_id)] = fingerprint
+    for scope, (message_id, fingerprint) in snapshot.get("panels", {}).items():
+        if message_id and state_store.get(scope, "message_id") == message_id:
+            published_panels[scope] = fingerprint
+    for message_id, names in snapshot.get("charts", {}).items():
+        chart_uploads[int(message_id)] = tuple(names)
+
+    for server_id, data in snapshot.get("snapshots", {}).items():
+        if int(server_id) in config.servers:
+            last_snapshots[int(server_id)] = data
+    for server_id, (data, age) in snapshot.get("shown", {}).items():
+        if int(server_id) in config.servers:
+            panel_throttle.shown[int(server_id)] = (data, now - age - downtime)
+    for server_id, age in snapshot.get("edited", {}).items():
+        if int(server_id) in config.servers:
+            panel_throttle.edited[int(server_id)] = now - age - downtime
+
+    for channel_id, (history, shown) in snapshot.get("voice", {}).items():
+        budget = voice_renamer.budget(int(channel_id))
+        budget.history.extend(at - offset for at in history if now - (at - offset) < VOICE_RENAME_WINDOW)
+        budget.shown = tuple(shown) if shown is not None else None
+
+    snapshot_log.info("Тёплый старт: снимку %.0fс, %d адресов в кэше, %d плашек, %d опросов просрочено",
+                      downtime, len(snapshot.get("cache", {})), len(published_embeds), len(overdue))
+
+# ==================== СИНХРОНИЗАЦИЯ КОМАНД ====================
+def command_tree_hash() -> str:
+    """Хэш сериализованного дерева команд (то, что ушло бы в Discord при sync)"""
+    payload = []
+    for command in tree.get_commands():
+        try:
+            payload.append(command.to_dict(tree))
+        except TypeError:
+            # discord.py < 2.4: to_dict() без аргументов
+            payload.append(command.to_dict())
+    payload.sort(key=lambda item: (item.get("type", 1), item["name"]))
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+async def sync_commands():
+    """Синхронизирует команды, только если дерево изменилось с прошлой синхронизации"""
+    current = command_tree_hash()
+    if state_store.get("commands", "global") == current:
+        bot_log.info("🔗 Команды не изменились, синхронизация пропущена")
+        return
 
     try:
         synced = await tree.sync()
-        print(f"🔗 Глобально синхронизировано {len(synced)} команд")
+        state_store.set("commands", "global", current)
+        bot_log.info("🔗 Глобально синхронизировано %d команд", len(synced))
     except Exception as e:
-        print(f"⚠️ Ошибка синхронизации команд: {e}")
+        bot_log.warning("⚠️ Ошибка синхронизации команд: %s", e)
         for guild in client.guilds:
+            key = f"guild:{guild.id}"
+            if state_store.get("commands", key) == current:
+                continue
             try:
                 await tree.sync(guild=guild)
-                print(f"🔗 Синхронизировано для сервера: {guild.name}")
+                state_store.set("commands", key, current)
+                bot_log.info("🔗 Синхронизировано для сервера: %s", guild.name)
             except Exception as e2:
-                print(f"⚠️ Ошибка для сервера {guild.name}: {e2}")
+                bot_log.warning("⚠️ Ошибка для сервера %s: %s", guild.name, e2)
+
+# ==================== ЗАПУСК БОТА ====================
+# on_ready приходит и после каждого переподключения к шлюзу; запуск делаем один раз
+startup_done = False
+
+def install_signal_handlers():
+    """SIGTERM (docker stop, systemctl stop) закрывает клиента так же, как Ctrl+C.
+
+    client.run() тогда возвращается, и main() успевает сохранить снимок и статистику.
+    """
+    loop = asyncio.get_running_loop()
+    closing = set()  # ссылка на задачу закрытия, чтобы её не собрал сборщик мусора
+
+    def on_sigterm():
+        bot_log.info("Получен SIGTERM, завершаю работу")
+        task = loop.create_task(client.close())
+        closing.add(task)
+        task.add_done_callback(closing.discard)
+
+    try:
+        loop.add_signal_handler(signal.SIGTERM, on_sigterm)
+    except (NotImplementedError, AttributeError):
+        # Windows: сигналы через цикл событий не поддерживаются
+        bot_log.warning("Обработчик SIGTERM не установлен: платформа не поддерживает сигналы в asyncio")
+
+@client.event
+async def on_ready():
+    global startup_done
+    if startup_done:
+        bot_log.info("🔌 Переподключение %s, фоновые задачи уже запущены", client.user)
+        return
+    startup_done = True
+    install_signal_handlers()
+
+    bot_log.info("✅ Бот %s запущен!", client.user)
+    bot_log.info("📊 Загружено серверов: %d", len(config.servers))
+    bot_log.info("🌐 Бот находится на %d серверах", len(client.guilds))
 
+    await sync_commands()
+
+    load_snapshot()
+    start_publish_workers()
+    await start_metrics_server()
     auto_update_servers.start()
-    print("🔄 Автообновление запущено")
+    bot_log.info("🔄 Автообновление запущено")
 
 def main():
+    initialize()
     if BOT_TOKEN == "ВАШ_ТОКЕН":
-        print("❌ ОШИБКА: Замените BOT_TOKEN на ваш токен из Discord Developer Portal!")
+        bot_log.error("❌ ОШИБКА: Замените BOT_TOKEN на ваш токен из Discord Developer Portal!")
         return
 
-    client.run(BOT_TOKEN)
+    try:
+        client.run(BOT_TOKEN)
+    finally:
+        # Сохраняем то, что ещё не записано на диск
+        config.flush()
+        save_snapshot()
+        stats_store.close()
+        state_store.close()
+        chart_renderer.close()
+        stop_logging()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
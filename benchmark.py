@@ -0,0 +1,351 @@
+"""Нагрузочный тест бота без интернета: локальные A2S-серверы и заглушка Discord REST.
+
+Каждый размер запускается в отдельном процессе с чистым состоянием бота во временной папке:
+
+    python benchmark.py --servers 10 100 1000 --cycles 3 --latency 0.02 --loss 0.01
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Optional
+
+import discord
+
+A2S_HEADER = b"\xFF\xFF\xFF\xFF"
+A2S_INFO_REQUEST = A2S_HEADER + b"TSource Engine Query\x00"
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Лимиты заглушки Discord: маршрут -> (запросов, за сколько секунд)
+FAKE_ROUTE_LIMITS = {
+    "message": (5, 5.0),
+    "channel": (2, 600.0),
+    "global": (50, 1.0)
+}
+
+def new_stats() -> dict:
+    return {
+        "a2s_requests": 0,   # датаграмм получено фейковыми серверами (с повторами и challenge)
+        "a2s_dropped": 0,    # потеряно по --loss
+        "rest_calls": 0,
+        "rest_429": 0,
+        "send": 0,
+        "edit": 0,
+        "fetch": 0,
+        "history": 0,
+        "delete": 0,
+        "rename": 0
+    }
+
+# ==================== ФЕЙКОВЫЙ A2S-СЕРВЕР ====================
+class FakeA2SServer(asyncio.DatagramProtocol):
+    """Отвечает на A2S_INFO с заданной задержкой, потерями и случайно гуляющим онлайном"""
+
+    def __init__(self, stats: dict, index: int, latency: float, jitter: float, loss: float,
+                 max_players: int, challenge: bool):
+        self.stats = stats
+        self.index = index
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.max_players = max_players
+        self.online = random.randint(0, max_players)
+        self.challenge = challenge
+        self.token = struct.pack("<I", random.getrandbits(32))
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        self.stats["a2s_requests"] += 1
+        if random.random() < self.loss:
+            self.stats["a2s_dropped"] += 1
+            return
+        if not data.startswith(A2S_INFO_REQUEST):
+            return
+
+        challenge = data[len(A2S_INFO_REQUEST):]
+        if self.challenge and challenge != self.token:
+            reply = A2S_HEADER + b"A" + self.token
+        else:
+            reply = self.info()
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        asyncio.get_running_loop().call_later(delay, self.transport.sendto, reply, addr)
+
+    def info(self) -> bytes:
+        self.online = max(0, min(self.max_players, self.online + random.randint(-2, 2)))
+        return (
+            A2S_HEADER + b"I" + bytes([17])
+            + f"Bench #{self.index}".encode() + b"\x00"
+            + b"de_dust2\x00" + b"cstrike\x00" + b"Counter-Strike\x00"
+            + struct.pack("<h", 10)
+            + bytes([self.online, self.max_players, 0])
+            + b"dl" + bytes([0, 1]) + b"1.0.0\x00"
+        )
+
+# ==================== ЗАГЛУШКА DISCORD ====================
+class FakeResponse:
+    def __init__(self, status: int, reason: str, headers: Optional[dict] = None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+class FakeDiscordAPI:
+    """Считает REST-вызовы и отвечает 429, как Discord, при превышении лимитов маршрута"""
+
+    def __init__(self, stats: dict, latency: float):
+        self.stats = stats
+        self.latency = latency
+        self.windows = {}  # маршрут -> время последних запросов
+
+    async def call(self, kind: str, route: str):
+        self.stats["rest_calls"] += 1
+        now = time.monotonic()
+
+        checks = [(route, FAKE_ROUTE_LIMITS[route.split(":", 1)[0]]), ("global", FAKE_ROUTE_LIMITS["global"])]
+        for key, (limit, period) in checks:
+            window = self.windows.setdefault(key, deque())
+            while window and now - window[0] >= period:
+                window.popleft()
+            if len(window) >= limit:
+                self.stats["rest_429"] += 1
+                retry_after = period - (now - window[0])
+                raise discord.HTTPException(
+                    FakeResponse(429, "Too Many Requests", {"Retry-After": f"{retry_after:.3f}"}),
+                    "You are being rate limited."
+                )
+        for key, _ in checks:
+            self.windows[key].append(now)
+
+        self.stats[kind] += 1
+        await asyncio.sleep(self.latency)
+
+class FakeMessage:
+    def __init__(self, channel, message_id: int, embeds=None):
+        self.channel = channel
+        self.id = message_id
+        self.embeds = list(embeds or [])
+        self.author = channel.bot_user
+        self.jump_url = f"https://discord.com/channels/0/{channel.id}/{message_id}"
+
+    async def edit(self, embed=None, embeds=None, attachments=None, **kwargs):
+        await self.channel.api.call("edit", f"message:{self.channel.id}")
+        stored = self.channel.messages.get(self.id)
+        if stored is None:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+        stored.embeds = [embed] if embed is not None else list(embeds or [])
+        return stored
+
+    async def delete(self):
+        await self.channel.api.call("delete", f"message:{self.channel.id}")
+        self.channel.messages.pop(self.id, None)
+
+class FakeTextChannel(discord.TextChannel):
+    """Текстовый канал без соединения с Discord: сообщения хранятся в памяти"""
+
+    def __init__(self, api: FakeDiscordAPI, channel_id: int, bot_user):
+        self.api = api
+        self.id = channel_id
+        self.name = f"bench-{channel_id}"
+        self.bot_user = bot_user
+        self.messages = {}
+        self.next_id = channel_id * 100000
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+    def get_partial_message(self, message_id: int):
+        return FakeMessage(self, message_id)
+
+    async def fetch_message(self, message_id: int):
+        await self.api.call("fetch", f"message:{self.id}")
+        message = self.messages.get(message_id)
+        if message is None:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+        return message
+
+    async def send(self, embed=None, embeds=None, file=None, files=None, **kwargs):
+        await self.api.call("send", f"message:{self.id}")
+        self.next_id += 1
+        message = FakeMessage(self, self.next_id, [embed] if embed is not None else embeds)
+        self.messages[message.id] = message
+        return message
+
+    async def history(self, limit: int = 100):
+        await self.api.call("history", f"message:{self.id}")
+        for message in list(self.messages.values())[::-1][:limit]:
+            yield message
+
+class FakeVoiceChannel(discord.VoiceChannel):
+    def __init__(self, api: FakeDiscordAPI, channel_id: int):
+        self.api = api
+        self.id = channel_id
+        self.name = f"bench-voice-{channel_id}"
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+    async def edit(self, name: str = None, **kwargs):
+        await self.api.call("rename", f"channel:{self.id}")
+        self.name = name
+
+# ==================== ПРОГОН ОДНОГО РАЗМЕРА ====================
+async def run_scale(args) -> dict:
+    """Поднимает args.child фейковых серверов, настраивает бота и гоняет циклы опроса"""
+    stats = new_stats()
+    loop = asyncio.get_running_loop()
+
+    servers = []
+    for index in range(args.child):
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda index=index: FakeA2SServer(
+                stats, index, args.latency, args.jitter, args.loss, args.max_players, not args.no_challenge
+            ),
+            local_addr=("127.0.0.1", 0)
+        )
+        servers.append(transport)
+
+    # Конфигурация пишется до инициализации бота — он загружает её в initialize()
+    settings = {}
+    for index, transport in enumerate(servers, start=1):
+        port = transport.get_extra_info("sockname")[1]
+        settings[index] = {
+            "ip": "127.0.0.1",
+            "port": port,
+            "name": f"Bench #{index}",
+            "text_channel_id": 1_000_000 + (index - 1) // args.per_channel,
+            "voice_channel_id": 2_000_000 + index if random.random() < args.voice_ratio else None,
+            "shared_panel": args.per_channel > 1
+        }
+    with open("config.json", "w", encoding="utf-8") as f:
+        json.dump(settings, f)
+
+    sys.path.insert(0, BOT_DIR)
+    import Bot
+    Bot.initialize()
+
+    api = FakeDiscordAPI(stats, args.rest_latency)
+    channels = {}
+    for server in Bot.config.servers.values():
+        channel_id = server["text_channel_id"]
+        if channel_id not in channels:
+            channels[channel_id] = FakeTextChannel(api, channel_id, Bot.client.user)
+        if server.get("voice_channel_id"):
+            channels[server["voice_channel_id"]] = FakeVoiceChannel(api, server["voice_channel_id"])
+    Bot.client.get_channel = channels.get
+    Bot.start_publish_workers()
+
+    cycles = []
+    for cycle in range(args.cycles):
+        if not args.warm_cache:
+            Bot.cache.clear()
+        # Все серверы должны быть опрошены в этом цикле, а не по своему расписанию,
+        # и проход не должен считаться догоняющим вызовом после предыдущего
+        now = time.monotonic()
+        Bot.cycle_monitor.last_start = None
+        Bot.poll_scheduler.sync(Bot.config.servers.keys(), now)
+        for server_id in Bot.config.servers:
+            Bot.poll_scheduler.schedule(server_id, now)
+
+        before = dict(stats)
+        started = time.perf_counter()
+        await Bot.auto_update_servers()
+        polled = time.perf_counter()
+
+        # Публикация идёт в фоне; ждём, пока очередь опустеет
+        deadline = polled + args.publish_timeout
+        while (len(Bot.publish_queue) or Bot.publish_queue._active) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        published = time.perf_counter()
+
+        result = {key: stats[key] - before[key] for key in stats}
+        result.update(cycle=cycle + 1, poll_time=polled - started, publish_time=published - polled)
+        cycles.append(result)
+
+    Bot.chart_renderer.close()
+    Bot.stats_store.flush()
+    Bot.stop_logging()
+    for transport in servers:
+        transport.close()
+    return {"servers": args.child, "cycles": cycles}
+
+def run_child(args):
+    os.chdir(tempfile.mkdtemp(prefix="bot-benchmark-"))
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = args.child * 2 + 256
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            limit = wanted if hard == resource.RLIM_INFINITY else min(hard, wanted)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    # Логи бота не нужны в отчёте
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = asyncio.run(run_scale(args))
+    print(json.dumps(result))
+
+# ==================== ОТЧЁТ ====================
+def print_report(results: list):
+    header = (f"{'Серверов':>8} {'Цикл':>4} {'Опрос, с':>9} {'Публ., с':>9} {'A2S':>6} {'Потер.':>6} "
+              f"{'REST':>6} {'429':>5} {'send':>5} {'edit':>5} {'fetch':>5} {'hist':>5} {'rename':>6}")
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        for cycle in result["cycles"]:
+            print(f"{result['servers']:>8} {cycle['cycle']:>4} {cycle['poll_time']:>9.3f} {cycle['publish_time']:>9.3f} "
+                  f"{cycle['a2s_requests']:>6} {cycle['a2s_dropped']:>6} {cycle['rest_calls']:>6} "
+                  f"{cycle['rest_429']:>5} {cycle['send']:>5} {cycle['edit']:>5} {cycle['fetch']:>5} "
+                  f"{cycle['history']:>5} {cycle['rename']:>6}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест опроса и публикации без сети")
+    parser.add_argument("--servers", type=int, nargs="+", default=[10, 100, 1000], help="размеры прогона")
+    parser.add_argument("--cycles", type=int, default=3, help="циклов опроса на размер")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа A2S (секунды)")
+    parser.add_argument("--jitter", type=float, default=0.01, help="случайная добавка к задержке A2S")
+    parser.add_argument("--loss", type=float, default=0.0, help="доля потерянных A2S пакетов")
+    parser.add_argument("--max-players", type=int, default=32)
+    parser.add_argument("--no-challenge", action="store_true", help="отвечать без challenge (старые серверы)")
+    parser.add_argument("--rest-latency", type=float, default=0.05, help="задержка ответа Discord REST")
+    parser.add_argument("--per-channel", type=int, default=1, help="серверов в одном текстовом канале (>1 — общие плашки)")
+    parser.add_argument("--voice-ratio", type=float, default=0.5, help="доля серверов с голосовым каналом")
+    parser.add_argument("--warm-cache", action="store_true", help="не очищать кэш запросов между циклами")
+    parser.add_argument("--publish-timeout", type=float, default=120.0, help="сколько ждать опустения очереди публикации")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(args)
+        return
+
+    passthrough = [arg for arg in sys.argv[1:]]
+    results = []
+    for count in args.servers:
+        print(f"[BENCH] Прогон на {count} серверах...", file=sys.stderr)
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *passthrough, "--child", str(count)],
+            capture_output=True, text=True
+        )
+        if process.returncode != 0:
+            print(process.stderr, file=sys.stderr)
+            sys.exit(process.returncode)
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    print_report(results)
+
+if __name__ == "__main__":
+    main()